@@ -0,0 +1,63 @@
+import argparse
+import hashlib
+import tempfile
+import time
+
+import filesdb
+from filesdb._filesdb import _hash_environment, _hash_metadata, _hash_metadata_many
+
+
+def _reference_hash_metadata(metadata, envhash=None):
+    # _hash_metadata before it was optimized
+    keys = list(metadata.keys())
+    keys.sort()
+    h = hashlib.sha256()
+    for k in keys:
+        h.update(bytes(str(k), 'utf-8'))
+        val = metadata[k]
+        if isinstance(val, str):
+            try:
+                val = float(val)
+            except ValueError:
+                pass
+        elif isinstance(val, int):
+            val = float(val)
+        h.update(bytes(str(val), 'utf-8'))
+    if envhash is not None:
+        h.update(bytes(str(envhash), 'utf-8'))
+    return h.hexdigest()
+
+
+def _sweep(n):
+    return [{'alpha': i % 7, 'beta': i * 0.5, 'method': ['fbp', 'sirt', 'mlem'][i % 3], 'iterations': str(i % 50),
+             'seed': i} for i in range(n)]
+
+
+def _rate(name, n, func):
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    print('{:<32}{:>12.0f} /s'.format(name, n / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark metadata hashing and bulk adds')
+    parser.add_argument('-n', type=int, default=100000, help='Number of metadata entries')
+    args = parser.parse_args()
+
+    metadatalist = _sweep(args.n)
+    environment = {'git': 'ab12cd34', 'host': 'node01', 'version': '2.2.2'}
+    envhash = _reference_hash_metadata(environment)
+    assert _hash_metadata_many(metadatalist, [envhash] * args.n) == [_reference_hash_metadata(m, envhash) for m in metadatalist]
+
+    _rate('reference hash', args.n, lambda: [_reference_hash_metadata(m, envhash) for m in metadatalist])
+    _rate('_hash_metadata', args.n, lambda: [_hash_metadata(m, envhash) for m in metadatalist])
+    _rate('_hash_metadata_many', args.n, lambda: _hash_metadata_many(metadatalist, [envhash] * args.n))
+    _rate('reference environment hash', args.n, lambda: [_reference_hash_metadata(environment) for _ in range(args.n)])
+    _rate('_hash_environment', args.n, lambda: [_hash_environment(environment) for _ in range(args.n)])
+    with tempfile.TemporaryDirectory() as wd:
+        _rate('add_many', args.n, lambda: filesdb.add_many(metadatalist, wd=wd, environment=environment))
+
+
+if __name__ == '__main__':
+    main()
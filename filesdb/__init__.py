@@ -1 +1,2 @@
 from ._filesdb import *
+from ._server import *
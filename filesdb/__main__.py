@@ -1,7 +1,11 @@
 import argparse
+import json
 import os
+import signal
+import sys
 
-from ._filesdb import add, search, delete, merge, _print_rows, _parse_metadata
+from ._filesdb import add, add_many, checksum, copy_many, coverage, distinct, exists, export_catalog, import_catalog, get_or_add, search_many, iter_search, delete, index, maintain, merge_many, purge, summary, undelete, verify, AGGREGATE_FUNCTIONS, AUTO_INDEX_MIN_COUNT, CATALOG_FORMATS, IMPORT_CHUNKSIZE, CHECKSUM_ALGORITHM, COMPARE_MODES, VACUUM_MODES, PROFILES, PROFILE_ENV, _print_rows, _parse_duration, _parse_metadata
+from ._server import serve
 
 
 def main():
@@ -9,34 +13,179 @@ def main():
     parser.add_argument('--db', '--database', type=str, default='files.db', help='Name of database file')
     parser.add_argument('--wd', '--working_directory', type=str, default='.')
     parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--profile', type=str, default=None, choices=sorted(PROFILES),
+                        help='Connection profile. Defaults to ${} or "default"'.format(PROFILE_ENV))
     subparsers = parser.add_subparsers()
 
     parser_search = subparsers.add_parser('search', help='Search database')
     parser_search.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
     parser_search.add_argument('-o', '--output_columns', type=str, default=None, help='Comma delimited list of column names to print')
+    parser_search.add_argument('--order_by', type=str, default=None,
+                               help='Comma delimited list of column names to sort by. Prefix a name with - for descending order')
+    parser_search.add_argument('--limit', type=int, default=None, help='Maximum number of rows to print')
+    parser_search.add_argument('--after', type=str, default=None, metavar='FILENAME',
+                               help='Only print the rows after this file in the --order_by order')
     parser_search.add_argument('metadata', nargs='*', help='list of keys and values', metavar='KEY=VALUE')
     parser_search.set_defaults(subcommand='search')
 
+    parser_summary = subparsers.add_parser('summary', help=('Print the number of files matching the search for each ' +
+                                                            'combination of values of the --group_by columns'))
+    parser_summary.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_summary.add_argument('-g', '--group_by', type=str, default=None, help='Comma delimited list of column names')
+    parser_summary.add_argument('-a', '--aggregate', type=str, action='append', default=[], metavar='FUNCTION:COLUMN',
+                                help='Also print an aggregate of a column. FUNCTION is one of {}. Can be repeated'.format(
+                                    ', '.join(AGGREGATE_FUNCTIONS)))
+    parser_summary.add_argument('metadata', nargs='*', help='list of keys and values', metavar='KEY=VALUE')
+    parser_summary.set_defaults(subcommand='summary')
+
+    parser_distinct = subparsers.add_parser('distinct', help='Print the distinct values of a column among the files matching the search')
+    parser_distinct.add_argument('column', type=str)
+    parser_distinct.add_argument('metadata', nargs='*', help='list of keys and values', metavar='KEY=VALUE')
+    parser_distinct.set_defaults(subcommand='distinct')
+
+    parser_coverage = subparsers.add_parser('coverage', help=('Print the number of files matching the search for each ' +
+                                                              'pair of values of two columns, as a matrix'))
+    parser_coverage.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_coverage.add_argument('rows', type=str, help='Column whose values label the rows')
+    parser_coverage.add_argument('columns', type=str, help='Column whose values label the columns')
+    parser_coverage.add_argument('metadata', nargs='*', help='list of keys and values', metavar='KEY=VALUE')
+    parser_coverage.set_defaults(subcommand='coverage')
+
+    parser_missing = subparsers.add_parser('missing', help=('Read one JSON object of metadata per line from stdin and ' +
+                                                            'print the ones that have not been added'))
+    parser_missing.set_defaults(subcommand='missing')
+
     parser_add = subparsers.add_parser('add', help=('Add file to database. If filename is not specified, ' +
                                                     'create a unique file name with extension given by ext'))
     parser_add.add_argument('--filename', type=str)
     parser_add.add_argument('--prefix', type=str, default='')
     parser_add.add_argument('--suffix', type=str, default='')
     parser_add.add_argument('--ext', type=str, default='')
+    parser_add.add_argument('--get_or_add', action='store_true',
+                            help='Print the name of an existing file with the same metadata instead of adding a new one')
     parser_add.add_argument('metadata', nargs='*', help='List of keys and values.', metavar='KEY=VALUE')
     parser_add.set_defaults(subcommand='add')
 
+    parser_exists = subparsers.add_parser('exists', help=('Check whether a file was added with exactly this metadata. ' +
+                                                          'Exits with an error if not'))
+    parser_exists.add_argument('metadata', nargs='*', help='List of keys and values.', metavar='KEY=VALUE')
+    parser_exists.set_defaults(subcommand='exists')
+
+    parser_add_many = subparsers.add_parser('add_many', help=('Add many files to database in one transaction. Reads one ' +
+                                                              'JSON object of metadata per line from stdin and ' +
+                                                              'prints the generated file names'))
+    parser_add_many.add_argument('--prefix', type=str, default='')
+    parser_add_many.add_argument('--suffix', type=str, default='')
+    parser_add_many.add_argument('--ext', type=str, default='')
+    parser_add_many.set_defaults(subcommand='add_many')
+
+    parser_import = subparsers.add_parser('import', help=('Add one file per row of a CSV or JSON lines file. Columns ' +
+                                                          'starting with environment. are the environment'))
+    parser_import.add_argument('infile', type=str, nargs='?', default='-', help='Input file. Defaults to stdin')
+    parser_import.add_argument('--format', type=str, default=None, choices=CATALOG_FORMATS,
+                               help='Input format. Defaults to csv for .csv files and jsonl otherwise')
+    parser_import.add_argument('--copy_mode', action='store_true',
+                               help='Keep the filename, time and envhash columns, e.g., of an export')
+    parser_import.add_argument('--chunksize', type=int, default=IMPORT_CHUNKSIZE, help='Rows added per transaction')
+    parser_import.add_argument('--prefix', type=str, default='')
+    parser_import.add_argument('--suffix', type=str, default='')
+    parser_import.add_argument('--ext', type=str, default='')
+    parser_import.set_defaults(subcommand='import')
+
+    parser_export = subparsers.add_parser('export', help='Write the files matching the search and their environments to a CSV or JSON lines file')
+    parser_export.add_argument('-o', '--outfile', type=str, default='-', help='Output file. Defaults to stdout')
+    parser_export.add_argument('--format', type=str, default=None, choices=CATALOG_FORMATS,
+                               help='Output format. Defaults to csv for .csv files and jsonl otherwise')
+    parser_export.add_argument('metadata', nargs='*', help='list of keys and values', metavar='KEY=VALUE')
+    parser_export.set_defaults(subcommand='export')
+
     parser_delete = subparsers.add_parser('delete', help='Delete files from database and working director')
     parser_delete.add_argument('-n', '--dry_run', action='store_true', help='Print entries to be delete, but do not delete')
     parser_delete.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter for dry run')
     parser_delete.add_argument('-o', '--output_columns', type=str, default=None, help='Comma delimited list of column names to print')
+    parser_delete.add_argument('-j', '--jobs', type=int, default=None, help='Number of files to remove in parallel')
+    parser_delete.add_argument('--trash', action='store_true',
+                               help='Move files to the trash, from which they can be restored until they are purged')
     parser_delete.add_argument('metadata', nargs='*', help='List of keys and values', metavar='KEY=VALUE')
     parser_delete.set_defaults(subcommand='delete')
 
-    parser_merge = subparsers.add_parser('merge', help='Merge input database into --db. (input remains unchanged)')
-    parser_merge.add_argument('input', type=str, help='Input database.')
+    parser_undelete = subparsers.add_parser('undelete', help='Restore the files and entries of a batch in the trash')
+    parser_undelete.add_argument('-j', '--jobs', type=int, default=None, help='Number of files to move in parallel')
+    parser_undelete.add_argument('batch', type=str, help='Batch printed by delete --trash')
+    parser_undelete.set_defaults(subcommand='undelete')
+
+    parser_purge = subparsers.add_parser('purge', help='Permanently remove batches in the trash')
+    parser_purge.add_argument('--older_than', '--older-than', type=str, default='0', metavar='AGE',
+                              help='Only remove batches deleted at least this long ago. Seconds, or a number followed by s, m, h or d')
+    parser_purge.add_argument('-n', '--dry_run', action='store_true', help='List the batches, but do not remove them')
+    parser_purge.add_argument('-j', '--jobs', type=int, default=None, help='Number of files to remove in parallel')
+    parser_purge.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_purge.set_defaults(subcommand='purge')
+
+    parser_merge = subparsers.add_parser('merge', help='Merge input databases into --db. (inputs remain unchanged)')
+    parser_merge.add_argument('--skip_conflicts', action='store_true',
+                              help='Skip and count rows that differ from the output database instead of failing')
+    parser_merge.add_argument('-j', '--jobs', type=int, default=None, help='Number of inputs to read in parallel')
+    parser_merge.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_merge.add_argument('input', type=str, nargs='+', help='Input databases.')
     parser_merge.set_defaults(subcommand='merge')
 
+    parser_copy = subparsers.add_parser('copy', help=('Copy files matching the search, or listed in --filenames, and their ' +
+                                                      'entries to another directory'))
+    parser_copy.add_argument('--outdb', type=str, default='files.db', help='Name of output database file')
+    parser_copy.add_argument('--hardlink', action='store_true', help='Hardlink files instead of copying')
+    parser_copy.add_argument('-j', '--jobs', type=int, default=None, help='Number of files to copy in parallel')
+    parser_copy.add_argument('--compare', type=str, default='content', choices=COMPARE_MODES,
+                             help=('How files already in the output directory are checked. "stat" trusts files with the ' +
+                                   'same size and modification time'))
+    parser_copy.add_argument('--filenames', type=str, default=None, metavar='FILE',
+                             help='File with one file name per line to copy, or - for stdin')
+    parser_copy.add_argument('outdir', type=str, help='Output directory')
+    parser_copy.add_argument('metadata', nargs='*', help='List of keys and values', metavar='KEY=VALUE')
+    parser_copy.set_defaults(subcommand='copy')
+
+    parser_checksum = subparsers.add_parser('checksum', help=('Record checksums of the files matching the search that ' +
+                                                              'do not have one yet'))
+    parser_checksum.add_argument('--algorithm', type=str, default=CHECKSUM_ALGORITHM, help='hashlib algorithm')
+    parser_checksum.add_argument('--force', action='store_true', help='Hash files that already have a checksum again')
+    parser_checksum.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes')
+    parser_checksum.add_argument('metadata', nargs='*', help='List of keys and values', metavar='KEY=VALUE')
+    parser_checksum.set_defaults(subcommand='checksum')
+
+    parser_verify = subparsers.add_parser('verify', help=('Check the files matching the search against their checksums. ' +
+                                                          'Only files modified since they were hashed are read'))
+    parser_verify.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes')
+    parser_verify.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_verify.add_argument('metadata', nargs='*', help='List of keys and values', metavar='KEY=VALUE')
+    parser_verify.set_defaults(subcommand='verify')
+
+    parser_index = subparsers.add_parser('index', help=('List indexes and search statistics, or create and drop ' +
+                                                         'indexes on metadata columns'))
+    parser_index_action = parser_index.add_mutually_exclusive_group()
+    parser_index_action.add_argument('--list', action='store_true', help='List indexes and search statistics (default)')
+    parser_index_action.add_argument('--auto', action='store_true',
+                                     help='Create indexes for columns searched at least --min_count times')
+    parser_index_action.add_argument('--create', type=str, metavar='COLUMNS', help='Comma delimited list of columns to index')
+    parser_index_action.add_argument('--drop', type=str, nargs='?', const='', metavar='COLUMNS',
+                                     help='Comma delimited list of columns of the index to drop. Drops all indexes if omitted')
+    parser_index.add_argument('--min_count', type=int, default=AUTO_INDEX_MIN_COUNT)
+    parser_index.add_argument('-d', '--delimiter', type=str, default='\t', help='Output column delimiter')
+    parser_index.set_defaults(subcommand='index')
+
+    parser_maintain = subparsers.add_parser('maintain', help=('Remove unused environments, update query planner ' +
+                                                              'statistics and vacuum the database'))
+    parser_maintain.add_argument('--drop_columns', action='store_true', help='Drop columns that are empty in every row')
+    parser_maintain.add_argument('--vacuum', type=str, default='incremental', choices=VACUUM_MODES + ('none',))
+    parser_maintain.set_defaults(subcommand='maintain')
+
+    parser_serve = subparsers.add_parser('serve', help=('Serve requests for the database on a unix socket, committing adds ' +
+                                                        'from many processes in batches. While running, add, search and ' +
+                                                        'delete go through the server'))
+    parser_serve.add_argument('--batch_time', type=float, default=0.01,
+                              help='Seconds to wait for more adds before committing')
+    parser_serve.add_argument('--batch_size', type=int, default=1000, help='Maximum number of rows per commit')
+    parser_serve.set_defaults(subcommand='serve')
+
     parser_test = subparsers.add_parser('test', help='Run tests')
     parser_test.set_defaults(subcommand='test')
 
@@ -47,23 +196,181 @@ def main():
 
     elif args.subcommand == 'search':
         metadata = _parse_metadata(args.metadata)
-        _print_rows(search(metadata, db=args.db, wd=args.wd, timeout=args.timeout), delimiter=args.delimiter,
-                    keys=None if args.output_columns is None else args.output_columns.split(','))
+        columns = None if args.output_columns is None else args.output_columns.split(',')
+        rows = iter_search(metadata, db=args.db, wd=args.wd, timeout=args.timeout, columns=columns,
+                           order_by=None if args.order_by is None else args.order_by.split(','), limit=args.limit,
+                           after=args.after, profile=args.profile)
+        _print_rows(rows, delimiter=args.delimiter, keys=columns)
+
+    elif args.subcommand == 'summary':
+        group_by = [] if args.group_by is None else args.group_by.split(',')
+        aggregate = {}
+        for item in args.aggregate:
+            function, _, column = item.partition(':')
+            aggregate.setdefault(column, []).append(function)
+        rows = summary(group_by, where=_parse_metadata(args.metadata), db=args.db, wd=args.wd, timeout=args.timeout,
+                       aggregate=aggregate, profile=args.profile)
+        _print_rows(rows, delimiter=args.delimiter)
+
+    elif args.subcommand == 'distinct':
+        for value in distinct(args.column, where=_parse_metadata(args.metadata), db=args.db, wd=args.wd,
+                              timeout=args.timeout, profile=args.profile):
+            print(value)
+
+    elif args.subcommand == 'coverage':
+        row_values, column_values, counts = coverage(args.rows, args.columns, where=_parse_metadata(args.metadata),
+                                                     db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile)
+        print(args.delimiter.join(['{}\\{}'.format(args.rows, args.columns)] + [str(v) for v in column_values]))
+        for value, row in zip(row_values, counts):
+            print(args.delimiter.join([str(value)] + [str(c) if c > 0 else '.' for c in row]))
+
+    elif args.subcommand == 'missing':
+        lines = [line.strip() for line in sys.stdin if line.strip()]
+        metadatalist = [json.loads(line) for line in lines]
+        try:
+            matches = search_many(metadatalist, db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile)
+        except FileNotFoundError:
+            # nothing has been added yet
+            matches = {i: [] for i in range(len(lines))}
+        for i, line in enumerate(lines):
+            if len(matches[i]) == 0:
+                print(line)
 
     elif args.subcommand == 'add':
         metadata = _parse_metadata(args.metadata)
-        filename = add(metadata, db=args.db, wd=args.wd, filename=args.filename, timeout=args.timeout, ext=args.ext,
-                       prefix=args.prefix, suffix=args.suffix)
+        if args.get_or_add:
+            filename, _ = get_or_add(metadata, db=args.db, wd=args.wd, filename=args.filename, timeout=args.timeout,
+                                     ext=args.ext, prefix=args.prefix, suffix=args.suffix, profile=args.profile)
+        else:
+            filename = add(metadata, db=args.db, wd=args.wd, filename=args.filename, timeout=args.timeout, ext=args.ext,
+                           prefix=args.prefix, suffix=args.suffix, profile=args.profile)
         print(filename)
 
+    elif args.subcommand == 'exists':
+        metadata = _parse_metadata(args.metadata)
+        if not exists(metadata, db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile):
+            sys.exit(1)
+
+    elif args.subcommand == 'add_many':
+        metadatalist = [json.loads(line) for line in sys.stdin if line.strip()]
+        filenames = add_many(metadatalist, db=args.db, wd=args.wd, timeout=args.timeout, ext=args.ext,
+                             prefix=args.prefix, suffix=args.suffix, profile=args.profile)
+        for filename in filenames:
+            print(filename)
+
+    elif args.subcommand == 'import':
+        count = import_catalog(args.infile, db=args.db, wd=args.wd, timeout=args.timeout, fmt=args.format,
+                               copy_mode=args.copy_mode, chunksize=args.chunksize, ext=args.ext, prefix=args.prefix,
+                               suffix=args.suffix, profile=args.profile)
+        print('imported {} files'.format(count), file=sys.stderr)
+
+    elif args.subcommand == 'export':
+        export_catalog(args.outfile, _parse_metadata(args.metadata), db=args.db, wd=args.wd, timeout=args.timeout,
+                       fmt=args.format, profile=args.profile)
+
     elif args.subcommand == 'delete':
         metadata = _parse_metadata(args.metadata)
-        rows = delete(metadata, db=args.db, wd=args.wd, timeout=args.timeout, dryrun=args.dry_run)
+        rows = delete(metadata, db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile, dryrun=args.dry_run,
+                      jobs=args.jobs, trash=args.trash)
         _print_rows(rows, delimiter=args.delimiter,
                     keys=None if args.output_columns is None else args.output_columns.split(','))
+        if hasattr(rows, 'batch'):
+            print('moved {} files to trash batch {}'.format(len(rows), rows.batch), file=sys.stderr)
+        for filename, e in sorted(rows.errors.items()):
+            print('{}: {}'.format(filename, e), file=sys.stderr)
+        if rows.errors:
+            sys.exit(1)
+
+    elif args.subcommand == 'undelete':
+        rows = undelete(args.batch, db=args.db, wd=args.wd, timeout=args.timeout, jobs=args.jobs, profile=args.profile)
+        for filename, e in sorted(rows.errors.items()):
+            print('{}: {}'.format(filename, e), file=sys.stderr)
+        print('restored {} files'.format(len(rows) - len(rows.errors)))
+        if rows.errors:
+            sys.exit(1)
+
+    elif args.subcommand == 'purge':
+        batches = purge(wd=args.wd, older_than=_parse_duration(args.older_than), dryrun=args.dry_run, jobs=args.jobs)
+        _print_rows(batches, delimiter=args.delimiter, keys=['batch', 'deleted', 'files', 'errors'])
+        if any(batch['errors'] for batch in batches):
+            sys.exit(1)
 
     elif args.subcommand == 'merge':
-        merge(args.input, args.db, wd=args.wd)
+        counts = merge_many(args.input, args.db, wd=args.wd, timeout=args.timeout, profile=args.profile,
+                            on_conflict='skip' if args.skip_conflicts else 'raise', jobs=args.jobs)
+        _print_rows(counts, delimiter=args.delimiter, keys=['input', 'inserted', 'skipped', 'conflicts'])
+
+    elif args.subcommand == 'copy':
+        if args.filenames is None:
+            filenames_or_query = _parse_metadata(args.metadata)
+        elif args.filenames == '-':
+            filenames_or_query = [line.strip() for line in sys.stdin if line.strip()]
+        else:
+            with open(args.filenames) as f:
+                filenames_or_query = [line.strip() for line in f if line.strip()]
+        report = copy_many(filenames_or_query, args.outdir, db=args.db, wd=args.wd, outdb=args.outdb,
+                           copytype='hardlink' if args.hardlink else 'copy', jobs=args.jobs, timeout=args.timeout,
+                           compare=args.compare, profile=args.profile)
+        for filename, e in sorted(report['errors'].items()):
+            print('{}: {}'.format(filename, e), file=sys.stderr)
+        print('copied {} files ({:.1f} MB) in {:.2f} s ({:.1f} MB/s), {} already copied, {} errors'.format(
+            report['copied'], report['bytes'] / 1e6, report['seconds'],
+            report['bytes'] / 1e6 / max(report['seconds'], 1e-6), report['skipped'], len(report['errors'])))
+        if report['errors']:
+            sys.exit(1)
+
+    elif args.subcommand == 'checksum':
+        metadata = _parse_metadata(args.metadata)
+        report = checksum(metadata, db=args.db, wd=args.wd, timeout=args.timeout, algorithm=args.algorithm,
+                          jobs=args.jobs, force=args.force, profile=args.profile)
+        for filename, e in sorted(report['errors'].items()):
+            print('{}: {}'.format(filename, e), file=sys.stderr)
+        print('hashed {} files ({:.1f} MB) in {:.2f} s ({:.1f} MB/s), {} errors'.format(
+            report['hashed'], report['bytes'] / 1e6, report['seconds'],
+            report['bytes'] / 1e6 / max(report['seconds'], 1e-6), len(report['errors'])))
+        if report['errors']:
+            sys.exit(1)
+
+    elif args.subcommand == 'verify':
+        metadata = _parse_metadata(args.metadata)
+        report = verify(metadata, db=args.db, wd=args.wd, timeout=args.timeout, jobs=args.jobs, profile=args.profile)
+        for filename, e in sorted(report['errors'].items()):
+            print('{}: {}'.format(filename, e), file=sys.stderr)
+        for status in 'changed', 'missing', 'unchecked':
+            for filename in sorted(report[status]):
+                print(status + args.delimiter + filename)
+        print('{} ok, {} changed, {} missing, {} unchecked, {:.1f} MB read in {:.2f} s'.format(
+            len(report['ok']), len(report['changed']), len(report['missing']), len(report['unchecked']),
+            report['bytes'] / 1e6, report['seconds']), file=sys.stderr)
+        if report['changed'] or report['missing'] or report['errors']:
+            sys.exit(1)
+
+    elif args.subcommand == 'index':
+        indexes = index(db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile,
+                        create=None if args.create is None else args.create.split(','),
+                        drop=None if args.drop is None else [c for c in args.drop.split(',') if c],
+                        auto=args.auto, min_count=args.min_count)
+        _print_rows(indexes, delimiter=args.delimiter)
+
+    elif args.subcommand == 'maintain':
+        report = maintain(db=args.db, wd=args.wd, timeout=args.timeout, drop_columns=args.drop_columns,
+                          vacuum=None if args.vacuum == 'none' else args.vacuum, profile=args.profile)
+        print('removed {} environments'.format(report['environments']))
+        for column in report['columns']:
+            print('dropped column {}'.format(column))
+        if report['vacuum'] == 'skipped':
+            print('vacuum skipped: the database must be vacuumed with --vacuum=full once before it can be vacuumed '
+                  'incrementally', file=sys.stderr)
+        print('reclaimed {:.1f} MB ({:.1f} MB -> {:.1f} MB)'.format(
+            report['reclaimed'] / 1e6, report['size_before'] / 1e6, report['size_after'] / 1e6))
+        for step, seconds in report['seconds'].items():
+            print('{}: {:.2f} s'.format(step, seconds))
+
+    elif args.subcommand == 'serve':
+        # shut down cleanly (and remove the socket) when terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        serve(db=args.db, wd=args.wd, timeout=args.timeout, profile=args.profile, batch_time=args.batch_time,
+              batch_size=args.batch_size)
 
     elif args.subcommand == 'test':
         import pytest
@@ -1,15 +1,30 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import atexit
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import csv
 import datetime
-import filecmp
+import functools
 import hashlib
+import itertools
+import json
 import os
+import random
+import re
 import shutil
+import socket
 import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
 
 
-__all__ = ['Row', 'RowList', 'add', 'merge', 'copy', 'delete', 'search', 'search_envs']
+__all__ = ['Database', 'Row', 'RowList', 'add', 'add_many', 'merge', 'merge_many', 'checksum', 'copy', 'copy_many', 'coverage', 'delete', 'distinct', 'exists', 'export_catalog', 'get_or_add', 'import_catalog', 'index', 'iter_search', 'maintain', 'purge', 'search', 'search_envs', 'search_many', 'summary', 'undelete', 'verify']
 
 
 # https://stackoverflow.com/questions/305378/list-of-tables-db-schema-dump-etc-using-the-python-sqlite3-api
@@ -20,8 +35,71 @@ __all__ = ['Row', 'RowList', 'add', 'merge', 'copy', 'delete', 'search', 'search
 # https://stackoverflow.com/questions/1535327/how-to-print-a-class-or-objects-of-class-using-print
 
 
-RESERVED_KEYS = 'filename', 'time'
+RESERVED_KEYS = 'filename', 'time', 'metahash'
+INDEX_PREFIX = 'filesdb_index_'
+# number of searches on a set of columns before index(auto=True) creates an index for it
+AUTO_INDEX_MIN_COUNT = 10
+# number of rows fetched at a time by iter_search
+SEARCH_ARRAYSIZE = 1000
+# number of environment hashes and string values kept by the metadata hashing caches
+HASH_CACHE_SIZE = 4096
+# bytes read at a time when comparing files
+COMPARE_BUFSIZE = 2**20
+# ways copy checks that a file already in the output directory is the same as the input. 'content' reads both
+# files unless they are the same file, differ in size, or have known digests. 'stat' also trusts files with
+# the same size and modification time
+COMPARE_MODES = 'content', 'stat'
+# checksum columns of filelist. the size and modification time (in ns) are those of the file when it was
+# hashed, so verify only has to read files that have been modified since
+CHECKSUM_KEYS = 'checksum_algorithm', 'checksum', 'checksum_size', 'checksum_mtime'
+CHECKSUM_ALGORITHM = 'sha256'
+# bytes read at a time when hashing files
+CHECKSUM_BUFSIZE = 4 * 2**20
+# delete(trash=True) moves files to TRASH_DIR/<batch>/files in the working directory, and saves their entries in
+# TRASH_DIR/<batch>/TRASH_MANIFEST, until they are purged
+TRASH_DIR = '.filesdb-trash'
+TRASH_MANIFEST = 'manifest.db'
+# columns that maintain never drops
+CORE_COLUMNS = 'filename', 'time', 'envhash', 'metahash'
+VACUUM_MODES = 'incremental', 'full'
+AGGREGATE_FUNCTIONS = 'count', 'min', 'max', 'sum', 'avg'
+# search results can be returned as a dict of numpy arrays, a pandas DataFrame or a pyarrow Table
+COLUMNAR_FORMATS = 'numpy', 'pandas', 'arrow'
+# catalogs are exported to and imported from csv or json lines files, one file per row. environment values are in
+# columns with ENVIRONMENT_PREFIX. imports are committed every IMPORT_CHUNKSIZE rows
+CATALOG_FORMATS = 'csv', 'jsonl'
+ENVIRONMENT_PREFIX = 'environment.'
+IMPORT_CHUNKSIZE = 50000
+
+# connection profiles. journal_mode, synchronous, mmap_size, cache_size and temp_store are set as pragmas when
+# a connection is opened (None keeps the sqlite default). retries is the number of times a write transaction
+# that finds the database locked is retried, with jittered exponential backoff starting at retry_delay seconds.
+# WAL journaling is not supported on network filesystems, so the default profile does not use it.
+PROFILES = {
+    'default': {},
+    'wal': {'journal_mode': 'wal', 'synchronous': 'normal', 'mmap_size': 256 * 2**20, 'cache_size': -64 * 2**10,
+            'retries': 10},
+    'bulk': {'synchronous': 'off', 'cache_size': -256 * 2**10, 'temp_store': 'memory', 'retries': 10},
+}
+PROFILE_PRAGMAS = 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store'
+PROFILE_ENV = 'FILESDB_PROFILE'
+RETRY_DELAY = 0.05
+RETRY_MAX_DELAY = 2.0
+
+# exceptions raised by a server are raised again in the client with the same type
+_SERVER_ERRORS = {e.__name__: e for e in (sqlite3.IntegrityError, sqlite3.OperationalError, FileNotFoundError, ValueError,
+                                          RuntimeError, TypeError, KeyError)}
 _NULL_OP_MAP = {'=': 'is', '==': 'is', '!=': 'is not', '<>': 'is not'}
+# key suffixes and the comparisons they select. keys without one are compared with =
+_KEY_OPS = ((':notin', 'not in'), (':in', 'in'), (':between', 'between'), (':like', 'like'), (':glob', 'glob'),
+            ('<=', '<='), ('>=', '>='), ('<', '<'), ('>', '>'), ('!', '!='))
+# comparisons with a list of values
+_LIST_OPS = 'in', 'not in', 'between'
+# comparisons of the command line KEY=VALUE syntax, and the key suffixes they correspond to
+_CMD_OPS = {'=': '', '!=': '!', '<=': '<=', '>=': '>=', '<': '<', '>': '>'}
+
+# cached Database handles, one per thread and (path, timeout)
+_local = threading.local()
 
 
 class Row(sqlite3.Row):
@@ -30,6 +108,41 @@ class Row(sqlite3.Row):
         return '\n'.join(['{}: {}'.format(key, self[key]) for key in self.keys()])
 
 
+class _Connection(sqlite3.Connection):
+
+    def __init__(self, *args, **kwargs):
+        super(_Connection, self).__init__(*args, **kwargs)
+        # column names per table, valid while the schema version is unchanged
+        self.columns = {}
+        self.schema_version = None
+        # searched column sets not yet written to the search_stats table
+        self.search_stats = collections.Counter()
+        self.profile = PROFILES['default']
+        # hashes of environments known to be in the database, valid while no other connection has written to it
+        self.envhashes = set()
+        self.data_version = None
+        # whether old rows were given metadata hashes, and the data_version when no rows were missing them
+        self.metahash_migrated = False
+        self.metahash_version = None
+
+    def _invalidate(self):
+        # columns and environments added in a transaction that was rolled back no longer exist
+        self.columns.clear()
+        self.schema_version = None
+        self.envhashes.clear()
+        self.metahash_migrated = False
+        self.metahash_version = None
+
+    def rollback(self):
+        self._invalidate()
+        super(_Connection, self).rollback()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._invalidate()
+        return super(_Connection, self).__exit__(exc_type, exc_value, traceback)
+
+
 class RowList(list):
 
     def _repr_html_(self):
@@ -67,50 +180,235 @@ def _key_val_list(d, separate_nulls=False):
         return keys, vals
 
 
-def _get_conn(db, wd, timeout=10):
-    conn = sqlite3.connect(os.path.join(wd, db), timeout=timeout)
+def _resolve_profile(profile=None):
+    if profile is None:
+        profile = os.environ.get(PROFILE_ENV) or 'default'
+    if profile not in PROFILES:
+        raise ValueError('unknown profile {}'.format(profile))
+    return profile
+
+
+def _get_conn(db, wd, timeout=10, profile=None):
+    conn = sqlite3.connect(os.path.join(wd, db), timeout=timeout, factory=_Connection)
     conn.row_factory = Row
-    with conn:
-        conn.execute('create table if not exists filelist (filename text primary key not null, time timestamp, envhash text)')
-        conn.execute('create table if not exists environments (envhash text primary key not null)')
-        _update_columns_incontext(conn, 'filelist', ['envhash'])
+    conn.profile = PROFILES[_resolve_profile(profile)]
+    if _with_retries(conn, lambda: conn.execute('pragma page_count').fetchone()[0]) == 0:
+        # new databases can be vacuumed incrementally (see maintain). this has to be set before anything is written
+        conn.execute('pragma auto_vacuum = incremental')
+    for pragma in PROFILE_PRAGMAS:
+        if conn.profile.get(pragma) is not None:
+            conn.execute('pragma {} = {}'.format(pragma, conn.profile[pragma]))
+    if _with_retries(conn, lambda: _schema_current(conn)):
+        # opening a database only reads it, so readers don't wait for writers
+        return conn
+    try:
+        with _transaction(conn):
+            conn.execute('create table if not exists filelist (filename text primary key not null, time timestamp, envhash text, '
+                         'metahash text)')
+            conn.execute('create table if not exists environments (envhash text primary key not null)')
+            conn.execute('create table if not exists search_stats (columns text primary key not null, count integer)')
+            if 'envhash' not in _query_columns(conn, 'filelist'):
+                conn.execute('alter table filelist add envhash NUMERIC')
+            conn.execute('create index if not exists filelist_envhash on filelist (envhash)')
+    except sqlite3.OperationalError as e:
+        # databases from older versions on read-only storage can still be searched
+        if not _is_readonly_error(e):
+            raise
     return conn
 
 
+def _schema_current(conn):
+    names = {row[0] for row in conn.execute("select name from sqlite_master where type in ('table', 'index')")}
+    if not {'filelist', 'environments', 'search_stats', 'filelist_envhash'} <= names:
+        return False
+    # metadata hashes are added by _migrate_metahash_incontext
+    return 'envhash' in _query_columns(conn, 'filelist')
+
+
+def _is_readonly_error(e):
+    return getattr(e, 'sqlite_errorname', None) == 'SQLITE_READONLY' or 'readonly database' in str(e)
+
+
+def _hash_value(val):
+    if isinstance(val, str):
+        return _hash_str(val)
+    elif isinstance(val, int):
+        return str(float(val))
+    return str(val)
+
+
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def _hash_str(val):
+    # strings that are numbers hash like the number
+    try:
+        return str(float(val))
+    except ValueError:
+        return val
+
+
 def _hash_metadata(metadata, envhash=None):
-    keys = list(metadata.keys())
-    keys.sort()
-    h = hashlib.sha256()
-    for k in keys:
-        h.update(bytes(str(k), 'utf-8'))
-        val = metadata[k]
-        if isinstance(val, str):
-            try:
-                val = float(val)
-            except ValueError:
-                pass
-        elif isinstance(val, int):
-            val = float(val)
-        h.update(bytes(str(val), 'utf-8'))
+    parts = []
+    for k in sorted(metadata.keys()):
+        parts.append(str(k))
+        parts.append(_hash_value(metadata[k]))
     if envhash is not None:
         # only add this if not None to preserve backwards compatibility
-        h.update(bytes(str(envhash), 'utf-8'))
-    return h.hexdigest()
+        parts.append(str(envhash))
+    return hashlib.sha256(''.join(parts).encode('utf-8')).hexdigest()
+
+
+def _hash_metadata_many(metadatalist, envhashes=None):
+    # same as [_hash_metadata(m, envhash=e) for m, e in zip(metadatalist, envhashes)], but the keys are only
+    # sorted once for each set of keys
+    if envhashes is None:
+        envhashes = [None] * len(metadatalist)
+    sorted_keys = {}
+    out = []
+    for metadata, envhash in zip(metadatalist, envhashes):
+        keys = tuple(metadata.keys())
+        if keys not in sorted_keys:
+            sorted_keys[keys] = [(k, str(k)) for k in sorted(keys)]
+        parts = []
+        for k, key_str in sorted_keys[keys]:
+            parts.append(key_str)
+            parts.append(_hash_value(metadata[k]))
+        if envhash is not None:
+            parts.append(str(envhash))
+        out.append(hashlib.sha256(''.join(parts).encode('utf-8')).hexdigest())
+    return out
+
+
+def _hash_environment(environment):
+    # environments are usually the same for many files, so their hashes are cached
+    return _hash_frozen_metadata(_normalize_environment(environment))
+
+
+def _normalize_environment(environment):
+    # environments are compared by the hashed representation of their values, since equal values (e.g., 0.0 and
+    # -0.0) can hash differently
+    return frozenset((k, _hash_value(v)) for k, v in environment.items())
+
+
+def _environment_list(environment, n):
+    # environment is None or a dictionary for all n metadata entries, or one of those per entry
+    if environment is None or isinstance(environment, dict):
+        return [environment] * n
+    environments = list(environment)
+    if len(environments) != n:
+        raise ValueError('environment must have one entry per metadata entry')
+    return environments
+
+
+@functools.lru_cache(maxsize=HASH_CACHE_SIZE)
+def _hash_frozen_metadata(items):
+    return hashlib.sha256(''.join(str(k) + v for k, v in sorted(items)).encode('utf-8')).hexdigest()
+
+
+def _metahash_metadata(metadata):
+    # the metadata hashed for the metahash column. unlike the file name, it ignores null values, so that it does
+    # not depend on the columns added by other files
+    keys, vals = _key_val_list({k: v for k, v in metadata.items()
+                                if v is not None and k not in RESERVED_KEYS + ('envhash',) + CHECKSUM_KEYS})
+    return dict(zip(keys, vals))
+
+
+def _metahash(metadata, envhash=None):
+    return _hash_metadata(_metahash_metadata(metadata), envhash=envhash)
+
+
+def _migrate_metahash_incontext(conn):
+    # databases from older versions, and rows added by them, have no metadata hashes. they are added on the first
+    # write (see _update_columns_incontext) or lookup, rather than when the database is opened, so that reading a
+    # large old database doesn't rewrite it
+    if getattr(conn, 'metahash_migrated', False):
+        return
+    columns = _table_columns(conn, 'filelist', validate=True)
+    if 'metahash' not in columns:
+        conn.execute('alter table filelist add metahash TEXT')
+        columns.add('metahash')
+    # not unique, the same metadata can be added with different file names
+    conn.execute('create index if not exists filelist_metahash on filelist (metahash)')
+    _backfill_metahash_incontext(conn)
+    if hasattr(conn, 'metahash_migrated'):
+        conn.metahash_migrated = True
+
+
+def _metahash_ready(conn):
+    # whether metadata hashes can be looked up. rows added by older versions since the last check are given
+    # hashes if the database can be written
+    version = conn.execute('pragma data_version').fetchone()[0]
+    if getattr(conn, 'metahash_version', None) == version:
+        return True
+    if 'metahash' not in _table_columns(conn, 'filelist', validate=True) or conn.execute(
+            'select 1 from filelist where metahash is null limit 1').fetchone() is not None:
+        conn.metahash_migrated = False
+        try:
+            if conn.in_transaction:
+                _migrate_metahash_incontext(conn)
+            else:
+                with _transaction(conn):
+                    _migrate_metahash_incontext(conn)
+        except sqlite3.OperationalError as e:
+            if not _is_readonly_error(e):
+                raise
+            return False
+    conn.metahash_version = version
+    return True
+
+
+def _backfill_metahash_incontext(conn):
+    while True:
+        rows = conn.execute('select * from filelist where metahash is null limit ?', (SEARCH_ARRAYSIZE,)).fetchall()
+        if len(rows) == 0:
+            break
+        conn.executemany('update filelist set metahash = ? where filename = ?',
+                         [(_metahash(dict(r), envhash=r['envhash']), r['filename']) for r in rows])
+
+
+def _query_columns(conn, table, schema='main'):
+    return {row[1] for row in conn.execute('pragma {}.table_info({})'.format(schema, table))}
+
+
+def _table_columns(conn, table, validate=False):
+    cache = getattr(conn, 'columns', None)
+    if cache is None:
+        return _query_columns(conn, table)
+    if validate or table not in cache:
+        version = conn.execute('pragma schema_version').fetchone()[0]
+        if version != conn.schema_version:
+            cache.clear()
+            conn.schema_version = version
+    if table not in cache:
+        cache[table] = _query_columns(conn, table)
+    return cache[table]
 
 
 def _update_columns_incontext(conn, table, keys, coltype='NUMERIC'):
-    desc = conn.execute('select * from {}'.format(table)).description
-    columns = [d[0] for d in desc]
+    keys = list(keys)
+    if table == 'filelist':
+        _migrate_metahash_incontext(conn)
+    for key in keys:
+        # such keys could not be searched for (see _parse_key)
+        if key[-1] == '!' or _parse_key(key)[1] != '=':
+            raise ValueError('key {} ends in a comparison operator'.format(key))
+    columns = _table_columns(conn, table)
+    if all(key in columns for key in keys):
+        return
+    # the cache may be stale if another connection changed the schema
+    columns = _table_columns(conn, table, validate=True)
+    altered = False
     for key in keys:
-        if key[-1] == '!':
-            raise ValueError('key {} ends in !'.format(key))
         if key not in columns:
             try:
                 conn.execute('alter table {} add {} {}'.format(table, _quote_single(key), coltype))
+                altered = True
             except sqlite3.OperationalError:
                 # column already exists. possible due to race condition between populating
                 # columns variable and adding the new column
                 pass
+            columns.add(key)
+    if altered and getattr(conn, 'columns', None) is not None:
+        conn.schema_version = conn.execute('pragma schema_version').fetchone()[0]
 
 
 def _quote(keys):
@@ -123,7 +421,694 @@ def _quote_single(key):
     return '"{}"'.format(key)
 
 
-def add(metadata, db='files.db', wd='.', filename=None, timeout=10, ext='', prefix='', suffix='', copy_mode=False, environment=None):
+class _NoServer(Exception):
+    pass
+
+
+def _socket_path(db, wd):
+    dirname, basename = os.path.split(os.path.join(wd, db))
+    return os.path.join(dirname, '.{}.sock'.format(basename))
+
+
+def _wire_default(obj):
+    if isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    if isinstance(obj, datetime.datetime):
+        # same format as the sqlite3 adapter
+        return obj.isoformat(' ')
+    raise TypeError('{} is not supported'.format(type(obj)))
+
+
+def _wire_hook(obj):
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    if '__rows__' in obj:
+        rows = _make_rows(obj['__rows__'], obj['values'])
+        if 'errors' in obj:
+            rows.errors = {filename: OSError(message) for filename, message in obj['errors'].items()}
+        if 'batch' in obj:
+            rows.batch = obj['batch']
+        return rows
+    return obj
+
+
+def _dumps(obj):
+    return (json.dumps(obj, default=_wire_default) + '\n').encode('utf-8')
+
+
+def _loads(line):
+    return json.loads(line.decode('utf-8'), object_hook=_wire_hook)
+
+
+def _rows_to_wire(rows):
+    out = {'__rows__': list(rows[0].keys()) if len(rows) > 0 else [], 'values': [tuple(r) for r in rows]}
+    if hasattr(rows, 'errors'):
+        out['errors'] = {filename: str(e) for filename, e in rows.errors.items()}
+    if hasattr(rows, 'batch'):
+        out['batch'] = rows.batch
+    return out
+
+
+def _make_rows(keys, values):
+    if len(values) == 0:
+        return RowList()
+    # Row can only be built from a cursor, which supplies the column names. the rows keep working once the
+    # connection is closed
+    with contextlib.closing(sqlite3.connect(':memory:')) as conn:
+        cursor = conn.execute('select ' + ', '.join('null as ' + _quote_single(k) for k in keys))
+        return RowList(Row(cursor, tuple(v)) for v in values)
+
+
+def _server_call(db, wd, op, **kwargs):
+    # raises _NoServer if no server is running for the database, so the caller can access it directly
+    path = _socket_path(db, wd)
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        raise _NoServer
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError:
+            # stale socket left by a server that did not shut down cleanly
+            raise _NoServer
+        with sock.makefile('rwb') as f:
+            f.write(_dumps({'op': op, 'kwargs': kwargs}))
+            f.flush()
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise RuntimeError('no response from server')
+    response = _loads(line)
+    if 'error' in response:
+        raise _SERVER_ERRORS.get(response['error'], RuntimeError)(response['message'])
+    return response['result']
+
+
+def _get_database(db, wd, timeout=10, must_exist=False, profile=None):
+    path = os.path.abspath(os.path.join(wd, db))
+    if must_exist and not os.path.exists(path):
+        raise FileNotFoundError('{} does not exist in {}'.format(db, wd))
+    databases = getattr(_local, 'databases', None)
+    if databases is None:
+        databases = _local.databases = {}
+    profile = _resolve_profile(profile)
+    key = (path, timeout, profile)
+    database = databases.get(key)
+    if database is not None and not database._is_current():
+        # the file was removed or replaced since the handle was opened
+        database.close()
+        database = None
+    if database is None:
+        database = databases[key] = Database(db, wd, timeout=timeout, profile=profile)
+    return database
+
+
+def _close_databases():
+    for database in getattr(_local, 'databases', {}).values():
+        database.close()
+    _local.databases = {}
+
+
+atexit.register(_close_databases)
+
+
+def _reset_databases():
+    # connections must not be shared with a forked child. the parent still owns them, so they are
+    # dropped here rather than closed
+    global _local
+    _local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_databases)
+
+
+def _with_retries(conn, func):
+    # retry func while the database is locked, as the profile of the connection allows
+    profile = getattr(conn, 'profile', PROFILES['default'])
+    retries = profile.get('retries', 0)
+    delay = profile.get('retry_delay', RETRY_DELAY)
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except sqlite3.OperationalError as e:
+            if attempt == retries or 'locked' not in str(e):
+                raise
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(2 * delay, RETRY_MAX_DELAY)
+
+
+def _begin_immediate(conn):
+    _with_retries(conn, lambda: conn.execute('begin immediate'))
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    # take the write lock up front, so that the transaction cannot fail to upgrade its lock part way through
+    _begin_immediate(conn)
+    with conn:
+        yield conn
+
+
+def _file_id(path):
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+# A long-lived handle to a database. The connection is opened and the schema is set up once. The module
+# level functions use a cached handle for each database path.
+class Database(object):
+
+    def __init__(self, db='files.db', wd='.', timeout=10, profile=None):
+        self.db = db
+        self.wd = wd
+        self.timeout = timeout
+        self.profile = _resolve_profile(profile)
+        self.path = os.path.join(wd, db)
+        self.conn = _get_conn(db, wd, timeout=timeout, profile=self.profile)
+        self._file_id = _file_id(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _is_current(self):
+        try:
+            return _file_id(self.path) == self._file_id
+        except FileNotFoundError:
+            return False
+
+    def close(self):
+        if getattr(self.conn, 'search_stats', None):
+            # best effort. don't keep the caller waiting on a busy database just to save statistics
+            try:
+                self.conn.execute('pragma busy_timeout = 100')
+                with self.conn:
+                    _flush_search_stats_incontext(self.conn)
+            except sqlite3.Error:
+                pass
+        self.conn.close()
+
+    def add(self, metadata, filename=None, ext='', prefix='', suffix='', copy_mode=False, environment=None):
+        with _transaction(self.conn):
+            _flush_search_stats_incontext(self.conn)
+            return _add_incontext(metadata, self.conn, filename=filename, ext=ext, prefix=prefix, suffix=suffix,
+                                  copy_mode=copy_mode, environment=environment)
+
+    def add_many(self, metadatalist, ext='', prefix='', suffix='', environment=None):
+        with _transaction(self.conn):
+            _flush_search_stats_incontext(self.conn)
+            return _add_metadata_many_incontext(metadatalist, self.conn, ext=ext, prefix=prefix, suffix=suffix,
+                                                environment=environment)
+
+    def exists(self, metadata, environment=None):
+        return len(_find_incontext(metadata, self.conn, environment=environment)) > 0
+
+    def search_many(self, metadatalist, environment=None):
+        metadatalist = list(metadatalist)
+        environments = _environment_list(environment, len(metadatalist))
+        envhashes = {}
+        probes = collections.defaultdict(list)
+        for i, (metadata, env) in enumerate(zip(metadatalist, environments)):
+            if env is not None and len(env) > 0:
+                key = _normalize_environment(env)
+                if key not in envhashes:
+                    envhashes[key] = _hash_frozen_metadata(key)
+                envhash = envhashes[key]
+            else:
+                envhash = None
+            probes[_metahash(metadata, envhash=envhash)].append(i)
+        out = {i: RowList() for i in range(len(metadatalist))}
+        if not _metahash_ready(self.conn):
+            for i, (metadata, env) in enumerate(zip(metadatalist, environments)):
+                out[i].extend(_find_incontext(metadata, self.conn, environment=env))
+            return out
+        for row in _select_in(self.conn, 'filelist', 'metahash', list(probes)):
+            for i in probes[row['metahash']]:
+                out[i].append(row)
+        return out
+
+    def import_catalog(self, infile, fmt=None, copy_mode=False, environment=None, chunksize=IMPORT_CHUNKSIZE, ext='',
+                       prefix='', suffix=''):
+        count = 0
+        with _open_catalog(infile, 'r') as f:
+            records = _read_catalog(f, _catalog_format(infile, fmt))
+            while True:
+                chunk = list(itertools.islice(records, chunksize))
+                if len(chunk) == 0:
+                    break
+                with _transaction(self.conn):
+                    _flush_search_stats_incontext(self.conn)
+                    _import_many_incontext(chunk, self.conn, copy_mode=copy_mode, environment=environment, ext=ext,
+                                           prefix=prefix, suffix=suffix)
+                count += len(chunk)
+        return count
+
+    def export_catalog(self, outfile, metadata=None, fmt=None, environment=None, arraysize=SEARCH_ARRAYSIZE):
+        fmt = _catalog_format(outfile, fmt)
+        # metahash is computed again on import
+        columns = ['filename', 'time', 'envhash'] + sorted(set(_table_columns(self.conn, 'filelist')) - set(CORE_COLUMNS))
+        envcolumns = sorted(set(_table_columns(self.conn, 'environments')) - {'envhash'})
+        cursor = _search_cursor(metadata or {}, self.conn, environment=environment, columns=columns)
+        environments = {}
+        count = 0
+        with _open_catalog(outfile, 'w') as f:
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(columns + [ENVIRONMENT_PREFIX + c for c in envcolumns])
+            for row in _iter_cursor(cursor, arraysize=arraysize):
+                envhash = row['envhash']
+                if envhash is not None and envhash not in environments:
+                    envrow = self.conn.execute('select * from environments where envhash = ?', (envhash,)).fetchone()
+                    environments[envhash] = {} if envrow is None else dict(envrow)
+                env = environments.get(envhash, {})
+                if fmt == 'csv':
+                    writer.writerow([_csv_value(v) for v in row] + [_csv_value(env.get(c)) for c in envcolumns])
+                else:
+                    record = {k: row[k] for k in columns if row[k] is not None}
+                    record.update((ENVIRONMENT_PREFIX + c, env[c]) for c in envcolumns if env.get(c) is not None)
+                    f.write(json.dumps(record, default=_wire_default) + '\n')
+                count += 1
+        return count
+
+    def summary(self, group_by, where=None, aggregate=None, environment=None):
+        return RowList(_summary_cursor(self.conn, group_by, where=where, aggregate=aggregate,
+                                       environment=environment).fetchall())
+
+    def distinct(self, column, where=None, environment=None):
+        return [row[0] for row in _summary_cursor(self.conn, [column], where=where, environment=environment)]
+
+    def coverage(self, row_column, column_column, where=None, environment=None):
+        rows = _summary_cursor(self.conn, [row_column, column_column], where=where, environment=environment).fetchall()
+        row_values = sorted({r[0] for r in rows}, key=_sort_key)
+        column_values = sorted({r[1] for r in rows}, key=_sort_key)
+        row_index = {v: i for i, v in enumerate(row_values)}
+        column_index = {v: i for i, v in enumerate(column_values)}
+        counts = [[0] * len(column_values) for _ in row_values]
+        for r in rows:
+            counts[row_index[r[0]]][column_index[r[1]]] = r['count']
+        return row_values, column_values, counts
+
+    def get_or_add(self, metadata, filename=None, ext='', prefix='', suffix='', environment=None):
+        with _transaction(self.conn):
+            rows = _find_incontext(metadata, self.conn, environment=environment)
+            if len(rows) > 0:
+                return rows[0]['filename'], False
+            _flush_search_stats_incontext(self.conn)
+            return _add_incontext(metadata, self.conn, filename=filename, ext=ext, prefix=prefix, suffix=suffix,
+                                  environment=environment), True
+
+    def search(self, metadata, verbose=False, keys_to_print=None, with_environments=False, environment=None, columns=None,
+               order_by=None, limit=None, after=None, as_=None):
+        return search(metadata, self.conn, verbose=verbose, keys_to_print=keys_to_print,
+                      with_environments=with_environments, environment=environment, columns=columns, order_by=order_by,
+                      limit=limit, after=after, as_=as_)
+
+    def iter_search(self, metadata, with_environments=False, environment=None, arraysize=SEARCH_ARRAYSIZE, columns=None,
+                    order_by=None, limit=None, after=None):
+        cursor = _search_cursor(metadata, self.conn, with_environments=with_environments, environment=environment,
+                                columns=columns, order_by=order_by, limit=limit, after=after)
+        return _iter_cursor(cursor, arraysize=arraysize)
+
+    def search_envs(self, metadata, verbose=False, keys_to_print=None, columns=None, order_by=None, limit=None, after=None):
+        return search_envs(metadata, self.conn, verbose=verbose, keys_to_print=keys_to_print, columns=columns,
+                           order_by=order_by, limit=limit, after=after)
+
+    def delete(self, metadata, dryrun=False, jobs=None, trash=False):
+        if len(metadata) == 0:
+            raise ValueError('must have at least one search parameter')
+        batchdir = None
+        with _transaction(self.conn):
+            rows = RowList(search(metadata, self.conn))
+            if len(rows) > 0 and not dryrun:
+                if trash:
+                    batch = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.urandom(4).hex())
+                    batchdir = os.path.join(self.wd, TRASH_DIR, batch)
+                    _write_manifest(self.conn, rows, batchdir)
+                    rows.batch = batch
+                expr, vals = _make_expression_vals(metadata)
+                try:
+                    self.conn.execute('delete from filelist where ' + expr, vals)
+                except Exception:
+                    if batchdir is not None:
+                        shutil.rmtree(batchdir)
+                    raise
+            _flush_search_stats_incontext(self.conn)
+        # the files are removed after the rows are committed, so other writers don't wait for the filesystem.
+        # files that can't be removed are left behind and reported
+        rows.errors = {}
+        if dryrun:
+            pass
+        elif batchdir is not None:
+            rows.errors = _move_files([r['filename'] for r in rows], self.wd, os.path.join(batchdir, 'files'), jobs=jobs)
+        else:
+            rows.errors = _remove_files([r['filename'] for r in rows], self.wd, jobs=jobs)
+        return rows
+
+    def maintain(self, drop_columns=False, vacuum='incremental'):
+        if vacuum is not None and vacuum not in VACUUM_MODES:
+            raise ValueError('unsupported vacuum mode {}'.format(vacuum))
+        if drop_columns and sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError('dropping columns requires sqlite 3.35 or newer')
+        report = {'environments': 0, 'columns': [], 'seconds': {}}
+        report['size_before'] = _database_size(self.conn)
+
+        # each step is a separate short transaction, so other processes only wait for one of them at a time
+        start = time.time()
+        with _transaction(self.conn):
+            _flush_search_stats_incontext(self.conn)
+            _migrate_metahash_incontext(self.conn)
+            report['environments'] = self.conn.execute(
+                'delete from environments where not exists '
+                '(select 1 from filelist where filelist.envhash = environments.envhash)').rowcount
+            self.conn.envhashes.clear()
+        report['seconds']['environments'] = time.time() - start
+
+        if drop_columns:
+            start = time.time()
+            with _transaction(self.conn):
+                for table in 'filelist', 'environments':
+                    for column in sorted(_table_columns(self.conn, table, validate=True) - _indexed_columns(self.conn, table)):
+                        if column in CORE_COLUMNS:
+                            continue
+                        if self.conn.execute('select 1 from {} where {} is not null limit 1'.format(
+                                table, _quote_single(column))).fetchone() is None:
+                            self.conn.execute('alter table {} drop column {}'.format(table, _quote_single(column)))
+                            report['columns'].append('{}.{}'.format(table, column))
+                self.conn._invalidate()
+            report['seconds']['columns'] = time.time() - start
+
+        start = time.time()
+        self.conn.execute('analyze')
+        self.conn.execute('pragma optimize')
+        report['seconds']['analyze'] = time.time() - start
+
+        report['vacuum'] = vacuum
+        if vacuum == 'incremental' and self.conn.execute('pragma auto_vacuum').fetchone()[0] != 2:
+            # databases from older versions need a full vacuum, which locks the database while it is rewritten,
+            # before they can be vacuumed incrementally. that is only done when asked for
+            report['vacuum'] = 'skipped'
+        elif vacuum is not None:
+            start = time.time()
+            if vacuum == 'incremental':
+                self.conn.execute('pragma incremental_vacuum').fetchall()
+            else:
+                # later vacuums can be incremental
+                self.conn.execute('pragma auto_vacuum = incremental')
+                self.conn.execute('vacuum')
+            report['seconds']['vacuum'] = time.time() - start
+
+        report['size_after'] = _database_size(self.conn)
+        # the statistics can make the database larger
+        report['reclaimed'] = max(report['size_before'] - report['size_after'], 0)
+        return report
+
+    def undelete(self, batch, jobs=None):
+        batchdir = os.path.join(self.wd, TRASH_DIR, batch)
+        if not os.path.exists(os.path.join(batchdir, TRASH_MANIFEST)):
+            raise FileNotFoundError('{} is not in the trash of {}'.format(batch, self.wd))
+        # raises if any of the files were added again since they were deleted
+        self.merge(os.path.join(TRASH_DIR, batch, TRASH_MANIFEST))
+        rows = _read_manifest(batchdir)
+        rows.errors = _move_files([r['filename'] for r in rows], os.path.join(batchdir, 'files'), self.wd, jobs=jobs)
+        if len(rows.errors) == 0:
+            shutil.rmtree(batchdir)
+        return rows
+
+    def index(self, create=None, drop=None, auto=False, min_count=AUTO_INDEX_MIN_COUNT):
+        with _transaction(self.conn):
+            _flush_search_stats_incontext(self.conn)
+            if create is not None:
+                _create_index_incontext(self.conn, create)
+            if drop is not None:
+                _drop_index_incontext(self.conn, drop)
+            if auto:
+                for columns, count in self.conn.execute('select columns, count from search_stats').fetchall():
+                    if count >= min_count:
+                        _create_index_incontext(self.conn, columns.split(','))
+        return _list_indexes(self.conn, min_count=min_count)
+
+    def merge(self, indb):
+        # indb is relative to the working directory of this database
+        path = os.path.join(self.wd, indb)
+        if not os.path.exists(path):
+            raise FileNotFoundError('{} does not exist in {}'.format(indb, self.wd))
+        with _attached(self.conn, path, 'mergedb'):
+            with _transaction(self.conn):
+                _flush_search_stats_incontext(self.conn)
+                return _merge_attached_incontext(self.conn, 'mergedb')
+
+    def merge_many(self, indbs, on_conflict='raise', jobs=None):
+        paths = [os.path.join(self.wd, indb) for indb in indbs]
+        for indb, path in zip(indbs, paths):
+            if not os.path.exists(path):
+                raise FileNotFoundError('{} does not exist in {}'.format(indb, self.wd))
+        # unify the schemas up front so that each input only has to insert rows
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or 1) as executor:
+            schemas = list(executor.map(_read_schema, paths))
+        with _transaction(self.conn):
+            for table in 'filelist', 'environments':
+                _update_columns_incontext(self.conn, table, sorted(set().union(*[schema[table] for schema in schemas])))
+            _flush_search_stats_incontext(self.conn)
+        out = []
+        for indb, path in zip(indbs, paths):
+            with _attached(self.conn, path, 'mergedb'):
+                with _transaction(self.conn):
+                    counts = _merge_attached_incontext(self.conn, 'mergedb', on_conflict=on_conflict)
+            counts['input'] = indb
+            out.append(counts)
+        return out
+
+    def copy(self, filename, outdir, outdb='files.db', copytype='copy', compare='content'):
+        rowin = self.search({'filename': filename})
+        assert len(rowin) == 1
+        rowin = rowin[0]
+        if rowin['envhash'] is not None:
+            envin = self.search_envs({'envhash': rowin['envhash']})
+            assert len(envin) == 1
+            envin = dict(envin[0])
+        else:
+            envin = None
+        # checksums describe the input file. the output file is only compared using checksums of its own
+        newrow = {k: v for k, v in dict(rowin).items() if k not in CHECKSUM_KEYS}
+        outrow = None
+        try:
+            row = search({'filename': filename}, db=outdb, wd=outdir, timeout=self.timeout, profile=self.profile)
+        except FileNotFoundError:
+            add(newrow, db=outdb, wd=outdir, timeout=self.timeout, profile=self.profile, copy_mode=True, environment=envin)
+        else:
+            if len(row) > 1:
+                raise RuntimeError('multiple entries found. this should be impossible')
+            elif len(row) == 1:
+                if not _cmprows(row[0], rowin):
+                    raise RuntimeError('filename already appears in output database, but with different parameters')
+                outrow = row[0]
+            else:
+                add(newrow, db=outdb, wd=outdir, timeout=self.timeout, profile=self.profile, copy_mode=True, environment=envin)
+        _copy_file(os.path.join(self.wd, filename), os.path.join(outdir, filename), copytype=copytype,
+                   compare=compare, row=rowin, outrow=outrow)
+
+    def copy_many(self, filenames_or_query, outdir, outdb='files.db', copytype='copy', jobs=None, compare='content'):
+        if copytype not in ('copy', 'hardlink'):
+            raise ValueError('unsupported copytype')
+        if compare not in COMPARE_MODES:
+            raise ValueError('unsupported compare mode {}'.format(compare))
+        start = time.time()
+        errors = {}
+        if isinstance(filenames_or_query, dict):
+            rows = self.search(filenames_or_query)
+        else:
+            filenames = list(filenames_or_query)
+            rows = _select_in(self.conn, 'filelist', 'filename', filenames)
+            found = {r['filename'] for r in rows}
+            for filename in filenames:
+                if filename not in found:
+                    errors[filename] = FileNotFoundError('{} is not in the input database'.format(filename))
+        envrows = _select_in(self.conn, 'environments', 'envhash', {r['envhash'] for r in rows if r['envhash'] is not None})
+
+        outdatabase = _get_database(outdb, outdir, timeout=self.timeout, profile=self.profile)
+        with _transaction(outdatabase.conn):
+            existing = {r['filename']: r for r in _select_in(outdatabase.conn, 'filelist', 'filename',
+                                                              [r['filename'] for r in rows])}
+            newrows = []
+            tocopy = []
+            for row in rows:
+                if row['filename'] not in existing:
+                    # checksums describe the input file. the output file is only compared using checksums of its own
+                    newrows.append({k: v for k, v in dict(row).items() if k not in CHECKSUM_KEYS})
+                elif not _cmprows(existing[row['filename']], row):
+                    errors[row['filename']] = RuntimeError('filename already appears in output database, but with '
+                                                           'different parameters')
+                    continue
+                tocopy.append(row)
+            outenvhashes = {r['envhash'] for r in _select_in(outdatabase.conn, 'environments', 'envhash',
+                                                             [r['envhash'] for r in envrows])}
+            _add_many_incontext([dict(r) for r in envrows if r['envhash'] not in outenvhashes], outdatabase.conn,
+                                tablename='environments')
+            _add_many_incontext(newrows, outdatabase.conn)
+
+        nbytes = 0
+        copied = 0
+        skipped = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(_copy_file, os.path.join(self.wd, row['filename']),
+                                       os.path.join(outdir, row['filename']), copytype, compare, row,
+                                       existing.get(row['filename'])): row['filename']
+                       for row in tocopy}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+                else:
+                    if result is None:
+                        # already in the output directory and identical
+                        skipped += 1
+                    else:
+                        copied += 1
+                        nbytes += result
+        return {'copied': copied, 'skipped': skipped, 'errors': errors, 'bytes': nbytes, 'seconds': time.time() - start}
+
+    def checksum(self, metadata, algorithm=CHECKSUM_ALGORITHM, jobs=None, force=False):
+        start = time.time()
+        hashlib.new(algorithm)
+        rows = [dict(r) for r in self.search(metadata)]
+        if not force:
+            rows = [r for r in rows if r.get('checksum') is None]
+        errors = {}
+        updates = []
+        nbytes = 0
+        for filename, result, e in _hash_files([r['filename'] for r in rows], self.wd, algorithm, jobs=jobs):
+            if e is not None:
+                errors[filename] = e
+            else:
+                updates.append((algorithm,) + result + (filename,))
+                nbytes += result[1]
+        with _transaction(self.conn):
+            _update_columns_incontext(self.conn, 'filelist', CHECKSUM_KEYS)
+            self.conn.executemany('update filelist set checksum_algorithm = ?, checksum = ?, checksum_size = ?, '
+                                  'checksum_mtime = ? where filename = ?', updates)
+        return {'hashed': len(updates), 'errors': errors, 'bytes': nbytes, 'seconds': time.time() - start}
+
+    def verify(self, metadata, jobs=None):
+        start = time.time()
+        report = {'ok': [], 'changed': [], 'missing': [], 'unchecked': [], 'errors': {}}
+        rehash = collections.defaultdict(list)
+        stored = {}
+        for row in self.search(metadata):
+            row = dict(row)
+            filename = row['filename']
+            if row.get('checksum') is None:
+                report['unchecked'].append(filename)
+                continue
+            try:
+                st = os.stat(os.path.join(self.wd, filename))
+            except FileNotFoundError:
+                report['missing'].append(filename)
+                continue
+            if st.st_size != row['checksum_size']:
+                report['changed'].append(filename)
+            elif st.st_mtime_ns == row['checksum_mtime']:
+                report['ok'].append(filename)
+            else:
+                # only files that were modified since they were hashed are read
+                rehash[row['checksum_algorithm']].append(filename)
+                stored[filename] = row['checksum']
+        updates = []
+        nbytes = 0
+        for algorithm, filenames in rehash.items():
+            for filename, result, e in _hash_files(filenames, self.wd, algorithm, jobs=jobs):
+                if isinstance(e, FileNotFoundError):
+                    report['missing'].append(filename)
+                elif e is not None:
+                    report['errors'][filename] = e
+                elif result[0] == stored[filename]:
+                    report['ok'].append(filename)
+                    # the contents are unchanged, so don't read the file again next time
+                    updates.append((result[1], result[2], filename))
+                    nbytes += result[1]
+                else:
+                    report['changed'].append(filename)
+                    nbytes += result[1]
+        if len(updates) > 0:
+            with _transaction(self.conn):
+                self.conn.executemany('update filelist set checksum_size = ?, checksum_mtime = ? where filename = ?',
+                                      updates)
+        report['bytes'] = nbytes
+        report['seconds'] = time.time() - start
+        return report
+
+
+def add(metadata, db='files.db', wd='.', filename=None, timeout=10, ext='', prefix='', suffix='', copy_mode=False, environment=None,
+        profile=None):
+    try:
+        return _server_call(db, wd, 'add', metadata=metadata, filename=filename, ext=ext, prefix=prefix, suffix=suffix,
+                            copy_mode=copy_mode, environment=environment)
+    except _NoServer:
+        pass
+    database = _get_database(db, wd, timeout=timeout, profile=profile)
+    return database.add(metadata, filename=filename, ext=ext, prefix=prefix, suffix=suffix, copy_mode=copy_mode,
+                        environment=environment)
+
+
+def add_many(metadatalist, db='files.db', wd='.', timeout=10, ext='', prefix='', suffix='', environment=None, profile=None):
+    # environment is either a single environment shared by all entries or a list with one per entry
+    try:
+        return _server_call(db, wd, 'add_many', metadatalist=list(metadatalist), ext=ext, prefix=prefix, suffix=suffix,
+                            environment=environment)
+    except _NoServer:
+        pass
+    database = _get_database(db, wd, timeout=timeout, profile=profile)
+    return database.add_many(metadatalist, ext=ext, prefix=prefix, suffix=suffix, environment=environment)
+
+
+def _find_incontext(metadata, conn, environment=None):
+    # the files added with exactly this metadata and environment, oldest first
+    envhash = _hash_environment(environment) if environment is not None and len(environment) > 0 else None
+    if not _metahash_ready(conn):
+        return _find_by_columns(metadata, conn, envhash)
+    return conn.execute('select * from filelist where metahash = ? order by time',
+                        (_metahash(metadata, envhash=envhash),)).fetchall()
+
+
+def _find_by_columns(metadata, conn, envhash=None):
+    # same as _find_incontext, for read-only databases without metadata hashes. every other column must be null
+    metadata = _metahash_metadata(metadata)
+    columns = _table_columns(conn, 'filelist', validate=True) - set(CORE_COLUMNS) - set(CHECKSUM_KEYS)
+    if any(key not in columns for key in metadata):
+        return []
+    full = {column: None for column in columns}
+    full.update(metadata)
+    full['envhash'] = envhash
+    expr, vals = _make_expression_vals(full)
+    return conn.execute('select * from filelist where {} order by time'.format(expr), vals).fetchall()
+
+
+def exists(metadata, db='files.db', wd='.', timeout=10, environment=None, profile=None):
+    # whether a file was added with this metadata and environment (null values are ignored)
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).exists(metadata,
+                                                                                           environment=environment)
+
+
+def search_many(metadatalist, db='files.db', wd='.', timeout=10, environment=None, profile=None):
+    # find the files added with exactly each metadata entry (see exists) with a single query. environment is a
+    # dictionary, or a list with one per metadata entry. returns a dictionary of matching rows by entry index
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).search_many(
+        metadatalist, environment=environment)
+
+
+def get_or_add(metadata, db='files.db', wd='.', filename=None, timeout=10, ext='', prefix='', suffix='', environment=None,
+               profile=None):
+    # returns the file name of the oldest file added with this metadata and environment, and False, or adds it
+    # and returns the new file name and True
+    return _get_database(db, wd, timeout=timeout, profile=profile).get_or_add(
+        metadata, filename=filename, ext=ext, prefix=prefix, suffix=suffix, environment=environment)
+
+
+def _add_incontext(metadata, conn, filename=None, ext='', prefix='', suffix='', copy_mode=False, environment=None):
     if len(metadata) == 0:
         raise ValueError('metadata must not be empty')
     if filename and (ext or prefix or suffix):
@@ -138,25 +1123,38 @@ def add(metadata, db='files.db', wd='.', filename=None, timeout=10, ext='', pref
         if 'time' not in metadata:
             raise ValueError('time must be in metadata in copy_mode')
         currtime = metadata.pop('time')
+        metadata.pop('metahash', None)
     else:
         currtime = datetime.datetime.now()
         for reserved_key in RESERVED_KEYS:
             if reserved_key in metadata.keys():
                 raise ValueError('{} is reserved'.format(reserved_key))
-    conn = _get_conn(db, wd, timeout=timeout)
-    with conn:
-        if environment is not None and len(environment) > 0:
-            hash_ = _add_environment_incontext(environment, conn, copy_mode=copy_mode)
-        else:
-            hash_ = None
-        _update_columns_incontext(conn, 'filelist', metadata.keys())
-        keys, vals = _key_val_list(metadata)
-        if filename is None:
-            filename = '{}{}{}{}'.format(prefix, _hash_metadata(metadata, envhash=hash_), suffix, ext)
-        conn.execute('insert into filelist (filename, time, envhash, ' + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * (len(vals) + 3)) + ')', [filename, currtime, hash_] + vals)
+    if environment is not None and len(environment) > 0:
+        hash_ = _add_environment_incontext(environment, conn, copy_mode=copy_mode)
+    else:
+        hash_ = None
+    _update_columns_incontext(conn, 'filelist', metadata.keys())
+    keys, vals = _key_val_list(metadata)
+    if filename is None:
+        filename = '{}{}{}{}'.format(prefix, _hash_metadata(metadata, envhash=hash_), suffix, ext)
+    _insert_incontext(conn, 'filelist', keys, 'insert into filelist (filename, time, envhash, metahash, ' + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * (len(vals) + 4)) + ')', [filename, currtime, hash_, _metahash(metadata, envhash=hash_)] + vals)
     return filename
 
 
+def _insert_incontext(conn, table, keys, statement, params, many=False):
+    # another connection may have dropped a column that is in the column cache (see maintain), in which case
+    # the cache is refreshed and the column added again
+    execute = conn.executemany if many else conn.execute
+    try:
+        return execute(statement, params)
+    except sqlite3.OperationalError as e:
+        if 'no column named' not in str(e):
+            raise
+        conn._invalidate()
+        _update_columns_incontext(conn, table, keys)
+        return execute(statement, params)
+
+
 def _add_environment_incontext(metadata, conn, copy_mode=False):
 
     if copy_mode:
@@ -164,23 +1162,61 @@ def _add_environment_incontext(metadata, conn, copy_mode=False):
         if 'envhash' not in metadata:
             raise ValueError('envhash must be in environment in copy_mode')
         hash_ = metadata.pop('envhash')
-        if hash_ != _hash_metadata(metadata):
+        if hash_ != _hash_environment(metadata):
             raise RuntimeError('passed hash does not match calculated. previous hash may be invalid')
     else:
-        hash_ = _hash_metadata(metadata)
-    existing = len(search_envs({'envhash': hash_}, conn))
-    if existing == 0:
-        _update_columns_incontext(conn, 'environments', metadata.keys())
-        keys, vals = _key_val_list(metadata)
-        try:
-            conn.execute('insert into environments (envhash, ' + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * (len(vals) + 1)) + ')', [hash_] + vals)
-        except sqlite3.IntegrityError:
-            # envhash already exists. possible due to race condition between checking
-            # envhash values
-            pass
+        hash_ = _hash_environment(metadata)
+    known = getattr(conn, 'envhashes', None)
+    if known:
+        # other connections may have removed environments (see maintain)
+        version = conn.execute('pragma data_version').fetchone()[0]
+        if version != conn.data_version:
+            known.clear()
+        if hash_ in known:
+            return hash_
+    _update_columns_incontext(conn, 'environments', metadata.keys())
+    keys, vals = _key_val_list(metadata)
+    # the environment may already exist
+    _insert_incontext(conn, 'environments', keys, 'insert or ignore into environments (envhash, ' + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * (len(vals) + 1)) + ')', [hash_] + vals)
+    if known is not None:
+        if len(known) == 0:
+            conn.data_version = conn.execute('pragma data_version').fetchone()[0]
+        known.add(hash_)
     return hash_
 
 
+def _add_metadata_many_incontext(metadatalist, conn, ext='', prefix='', suffix='', environment=None):
+    metadatalist = list(metadatalist)
+    environments = _environment_list(environment, len(metadatalist))
+    currtime = datetime.datetime.now()
+    envhashes = {}
+    hashes = []
+    for metadata, env in zip(metadatalist, environments):
+        if len(metadata) == 0:
+            raise ValueError('metadata must not be empty')
+        for reserved_key in RESERVED_KEYS:
+            if reserved_key in metadata.keys():
+                raise ValueError('{} is reserved'.format(reserved_key))
+        _key_val_list(metadata)
+        if env is not None and len(env) > 0:
+            # each distinct environment is hashed and added once
+            key = _normalize_environment(env)
+            if key not in envhashes:
+                envhashes[key] = _add_environment_incontext(env, conn)
+            hashes.append(envhashes[key])
+        else:
+            hashes.append(None)
+    filenames = ['{}{}{}{}'.format(prefix, h, suffix, ext) for h in _hash_metadata_many(metadatalist, hashes)]
+    metahashes = _hash_metadata_many([_metahash_metadata(metadata) for metadata in metadatalist], hashes)
+    rows = []
+    for metadata, filename, hash_, metahash in zip(metadatalist, filenames, hashes, metahashes):
+        row = dict(metadata)
+        row.update(filename=filename, time=currtime, envhash=hash_, metahash=metahash)
+        rows.append(row)
+    _add_many_incontext(rows, conn)
+    return filenames
+
+
 def _add_many_incontext(metadatalist, conn, tablename='filelist', db='files.db', wd='.', timeout=10):
     if len(metadatalist) == 0:
         return
@@ -196,16 +1232,144 @@ def _add_many_incontext(metadatalist, conn, tablename='filelist', db='files.db',
         for key in keys:
             tmplist.append(metadata.get(key, None))
         vals.append(tmplist)
-    conn.executemany('insert into {} ('.format(tablename) + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * len(keys)) + ')', vals)
+    _insert_incontext(conn, tablename, keys, 'insert into {} ('.format(tablename) + ', '.join(_quote(keys)) + ') values (' + ', '.join(['?'] * len(keys)) + ')', vals, many=True)
+
+
+def _catalog_format(path, fmt=None):
+    if fmt is None:
+        fmt = 'csv' if isinstance(path, str) and path.lower().endswith('.csv') else 'jsonl'
+    if fmt not in CATALOG_FORMATS:
+        raise ValueError('unsupported catalog format {}'.format(fmt))
+    return fmt
+
+
+@contextlib.contextmanager
+def _open_catalog(path, mode):
+    # path is a file name, - for stdin or stdout, or an open file
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    elif not isinstance(path, str):
+        yield path
+    else:
+        with open(path, mode, newline='') as f:
+            yield f
+
+
+def _csv_value(val):
+    # null is an empty field, and bytes are tagged base64 as in json
+    if val is None:
+        return ''
+    elif isinstance(val, bytes):
+        return json.dumps(_wire_default(val))
+    return val
+
+
+def _from_csv_value(val):
+    if val == '':
+        return None
+    elif val.startswith('{"__bytes__"'):
+        try:
+            return json.loads(val, object_hook=_bytes_hook)
+        except ValueError:
+            pass
+    return val
+
+
+def _bytes_hook(obj):
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def _read_catalog(f, fmt):
+    # yields one dictionary per row. empty csv fields are null
+    if fmt == 'csv':
+        for record in csv.DictReader(f):
+            yield {k: _from_csv_value(v) for k, v in record.items()}
+    else:
+        for line in f:
+            if line.strip():
+                record = json.loads(line, object_hook=_bytes_hook)
+                if not isinstance(record, dict):
+                    raise ValueError('each line must be a json object')
+                yield record
+
+
+def _import_many_incontext(records, conn, copy_mode=False, environment=None, ext='', prefix='', suffix=''):
+    # the environment of each record is in its ENVIRONMENT_PREFIX columns, if any, and otherwise environment
+    metadatalist = []
+    environments = []
+    for record in records:
+        metadata = {}
+        env = {}
+        for key, val in record.items():
+            if val is None:
+                continue
+            if key.startswith(ENVIRONMENT_PREFIX):
+                env[key[len(ENVIRONMENT_PREFIX):]] = val
+            else:
+                metadata[key] = val
+        if copy_mode and metadata.get('envhash') is not None:
+            env['envhash'] = metadata['envhash']
+        if len(env) == 0:
+            env = environment
+        if env is not None:
+            _key_val_list(env)
+        metadatalist.append(metadata)
+        environments.append(env)
+    if not copy_mode:
+        return _add_metadata_many_incontext(metadatalist, conn, ext=ext, prefix=prefix, suffix=suffix,
+                                            environment=environments)
+    # like add with copy_mode, the file names, times and environment hashes are kept
+    envhashes = {}
+    hashes = []
+    for metadata, env in zip(metadatalist, environments):
+        for key in ('filename', 'time'):
+            if key not in metadata:
+                raise ValueError('{} must be in metadata in copy_mode'.format(key))
+        metadata.pop('metahash', None)
+        if env is not None and len(env) > 0:
+            key = _normalize_environment(env)
+            if key not in envhashes:
+                envhashes[key] = _add_environment_incontext(env, conn, copy_mode='envhash' in env)
+            metadata['envhash'] = envhashes[key]
+        _key_val_list(metadata)
+        hashes.append(metadata.get('envhash'))
+    metahashes = _hash_metadata_many([_metahash_metadata(metadata) for metadata in metadatalist], hashes)
+    for metadata, metahash in zip(metadatalist, metahashes):
+        metadata['metahash'] = metahash
+    _add_many_incontext(metadatalist, conn)
+    return [metadata['filename'] for metadata in metadatalist]
 
 
 def _parse_key(key):
-    if key[-1] == '!':
-        key = key[:-1]
-        op = '!='
+    for suffix, op in _KEY_OPS:
+        if key.endswith(suffix) and len(key) > len(suffix):
+            return key[:-len(suffix)], op
+    return key, '='
+
+
+def _list_expression(column, key, op, val):
+    if isinstance(val, (str, bytes)) or not hasattr(val, '__iter__'):
+        raise ValueError('{} needs a list of values'.format(key))
+    vals = list(val)
+    for v in vals:
+        _key_val_list({key: v})
+    if op == 'between':
+        if len(vals) != 2 or None in vals:
+            raise ValueError('{} needs two values for between'.format(key))
+        return '{} between ? and ?'.format(column), vals
+    nonnull = [v for v in vals if v is not None]
+    placeholders = ', '.join(['?'] * len(nonnull))
+    if op == 'in':
+        expr = '{} in ({})'.format(column, placeholders)
+        if len(nonnull) < len(vals):
+            expr = '({} or {} is null)'.format(expr, column)
+    elif len(nonnull) < len(vals):
+        expr = '({col} not in ({p}) and {col} is not null)'.format(col=column, p=placeholders)
     else:
-        op = '='
-    return key, op
+        expr = '({col} not in ({p}) or {col} is null)'.format(col=column, p=placeholders)
+    return expr, nonnull
 
 
 def _make_expression_vals(metadata, environment=None):
@@ -214,163 +1378,781 @@ def _make_expression_vals(metadata, environment=None):
     search_strs = []
     vals_out = []
     for data, table in zip([metadata, environment], ['filelist', 'environments']):
-        keys, vals, null_keys = _key_val_list(data, separate_nulls=True)
-        vals_out.extend(vals)
-        if len(keys) > 0:
-            for key in keys:
-                key, op = _parse_key(key)
-                if op in ['!=', '<>']:
-                    search_strs.append('({table}.{key}{op}? or {table}.{key} is null)'.format(table=table, key=_quote_single(key), op=op))
-                else:
-                    search_strs.append('{table}.{key}{op}?'.format(table=table, key=_quote_single(key), op=op))
-        if len(null_keys) > 0:
-            nullkey_ops = [_parse_key(key) for key in null_keys]
-            search_strs.append(' and '.join(['{table}.{key} {op} null'.format(table=table, key=_quote_single(key), op=_NULL_OP_MAP[op]) for key, op in nullkey_ops]))
+        null_strs = []
+        for key, val in data.items():
+            key, op = _parse_key(key)
+            column = '{}.{}'.format(table, _quote_single(key))
+            if op in _LIST_OPS:
+                expr, vals = _list_expression(column, key, op, val)
+                search_strs.append(expr)
+                vals_out.extend(vals)
+                continue
+            _key_val_list({key: val})
+            if val is None:
+                if op not in _NULL_OP_MAP:
+                    raise ValueError('{} {} None is not supported'.format(key, op))
+                null_strs.append('{} {} null'.format(column, _NULL_OP_MAP[op]))
+            elif op in ['!=', '<>']:
+                search_strs.append('({col}{op}? or {col} is null)'.format(col=column, op=op))
+                vals_out.append(val)
+            elif op in ['like', 'glob']:
+                search_strs.append('{} {} ?'.format(column, op))
+                vals_out.append(val)
+            else:
+                search_strs.append('{}{}?'.format(column, op))
+                vals_out.append(val)
+        if len(null_strs) > 0:
+            search_strs.append(' and '.join(null_strs))
     expr = ' and '.join(search_strs)
     return expr, vals_out
 
 
 def search(metadata, conn=None, db='files.db', wd='.', timeout=10, verbose=False, keys_to_print=None, parse_exclamation=False,
-           with_environments=False, environment=None):
+           with_environments=False, environment=None, columns=None, order_by=None, limit=None, after=None, as_=None,
+           profile=None):
+    # columns selects the columns returned. order_by is a column name or list of names, which are sorted in
+    # descending order if they start with -. after is a file name, or a row with the order_by columns, and
+    # returns the rows that follow it in that order (see _select_cursor). as_ returns the columns of the result
+    # in one of COLUMNAR_FORMATS instead of a RowList
+    if as_ is not None:
+        if as_ not in COLUMNAR_FORMATS:
+            raise ValueError('as_ must be one of {}'.format(', '.join(COLUMNAR_FORMATS)))
+        if conn is None:
+            conn = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).conn
+        cursor = _search_cursor(metadata, conn, with_environments=with_environments, environment=environment,
+                                columns=columns, order_by=order_by, limit=limit, after=after)
+        return _to_columnar(*_fetch_columns(cursor), as_=as_)
     if conn is None:
-        if not os.path.exists(os.path.join(wd, db)):
-            raise FileNotFoundError('{} does not exist in {}'.format(db, wd))
-        conn = _get_conn(db, wd, timeout=timeout)
-    basestr = 'select * from filelist'
-    if with_environments or environment is not None:
-        basestr += ' inner join environments on filelist.envhash = environments.envhash'
-    if len(metadata) > 0 or environment is not None:
-        expr, vals = _make_expression_vals(metadata, environment)
-        query_string = basestr + ' where ' + expr
-        rows = conn.execute(query_string, vals).fetchall()
-    else:
-        rows = conn.execute(basestr).fetchall()
+        try:
+            rows = _server_call(db, wd, 'search', metadata=metadata, with_environments=with_environments,
+                                environment=environment, columns=columns, order_by=order_by, limit=limit,
+                                after=after if after is None or isinstance(after, str) else dict(after))
+        except _NoServer:
+            conn = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).conn
+    if conn is not None:
+        rows = _search_cursor(metadata, conn, with_environments=with_environments, environment=environment,
+                              columns=columns, order_by=order_by, limit=limit, after=after).fetchall()
     if verbose:
         _print_rows(rows, keys=keys_to_print)
     return RowList(rows)
 
 
-def search_envs(metadata, conn=None, db='files.db', wd='.', timeout=10, verbose=False, keys_to_print=None, parse_exclamation=False):
+def iter_search(metadata, db='files.db', wd='.', timeout=10, with_environments=False, environment=None,
+                arraysize=SEARCH_ARRAYSIZE, columns=None, order_by=None, limit=None, after=None, profile=None):
+    # like search, but yields rows as they are fetched, arraysize at a time. while a server is running, the rows
+    # are read by the server and returned at once
+    try:
+        return iter(_server_call(db, wd, 'search', metadata=metadata, with_environments=with_environments,
+                                 environment=environment, columns=columns, order_by=order_by, limit=limit,
+                                 after=after if after is None or isinstance(after, str) else dict(after)))
+    except _NoServer:
+        pass
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).iter_search(
+        metadata, with_environments=with_environments, environment=environment, arraysize=arraysize, columns=columns,
+        order_by=order_by, limit=limit, after=after)
+
+
+def _from_clause(with_environments=False, environment=None):
+    # returns the from clause of a search and the tables in it
+    if with_environments or environment is not None:
+        return 'filelist inner join environments on filelist.envhash = environments.envhash', ['filelist', 'environments']
+    return 'filelist', ['filelist']
+
+
+def _where_clause(metadata, conn, environment=None):
+    if len(metadata) > 0 or environment is not None:
+        _record_search(conn, metadata)
+        return _make_expression_vals(metadata, environment)
+    return '', []
+
+
+def _column_ref(conn, tables, column):
+    # columns are taken from the first table that has them. sqlite would take an unknown quoted column for a
+    # string
+    for validate in (False, True):
+        # another connection may have added the column since the columns were cached
+        for table in tables:
+            if column in _table_columns(conn, table, validate=validate):
+                return '{}.{}'.format(table, _quote_single(column))
+    raise ValueError('column {} does not exist'.format(column))
+
+
+def _search_cursor(metadata, conn, with_environments=False, environment=None, columns=None, order_by=None, limit=None,
+                   after=None):
+    fromstr, tables = _from_clause(with_environments, environment)
+    expr, vals = _where_clause(metadata, conn, environment=environment)
+    return _select_cursor(conn, fromstr, tables, 'filename', expr, vals, columns=columns, order_by=order_by,
+                          limit=limit, after=after)
+
+
+def _select_cursor(conn, fromstr, tables, key, expr, vals, columns=None, order_by=None, limit=None, after=None):
+    # key is a unique column of the first table, which breaks ties in the order, so that the rows after a given
+    # row (keyset pagination) are well defined. limited results are sorted by key if order_by is not given, so
+    # that pages are consistent
+    def ref(column):
+        return _column_ref(conn, tables, column)
+
+    query = 'select {} from {}'.format('*' if columns is None else ', '.join(ref(c) for c in columns), fromstr)
+    where = [expr] if expr else []
+    vals = list(vals)
+    order = []
+    if order_by is not None or after is not None or limit is not None:
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        order = [(c[1:], 'desc') if c.startswith('-') else (c, 'asc') for c in order_by or []]
+        if key not in [c for c, _ in order]:
+            order.append((key, 'asc'))
+    if after is not None:
+        if isinstance(after, str):
+            row = conn.execute('select {} from {} where {} = ?'.format(', '.join(ref(c) for c, _ in order), fromstr, ref(key)),
+                               (after,)).fetchone()
+            if row is None:
+                raise ValueError('{} not found'.format(after))
+            values = list(row)
+        else:
+            try:
+                values = [after[c] for c, _ in order]
+            except (KeyError, IndexError):
+                raise ValueError('after must include {}'.format(', '.join(c for c, _ in order)))
+        # rows equal in the preceding columns and after the row in this one. ascending order puts nulls first
+        terms = []
+        for i, ((column, direction), value) in enumerate(zip(order, values)):
+            term = ['{} is ?'.format(ref(c)) for c, _ in order[:i]]
+            term_vals = values[:i]
+            if direction == 'asc' and value is None:
+                term.append('{} is not null'.format(ref(column)))
+            elif direction == 'asc':
+                term.append('{} > ?'.format(ref(column)))
+                term_vals = term_vals + [value]
+            elif value is not None:
+                term.append('({col} < ? or {col} is null)'.format(col=ref(column)))
+                term_vals = term_vals + [value]
+            else:
+                continue
+            terms.append('(' + ' and '.join(term) + ')')
+            vals.extend(term_vals)
+        where.append('(' + ' or '.join(terms) + ')' if terms else '0')
+    if len(where) > 0:
+        query += ' where ' + ' and '.join(where)
+    if len(order) > 0:
+        query += ' order by ' + ', '.join('{} {}'.format(ref(c), direction) for c, direction in order)
+    if limit is not None:
+        query += ' limit ?'
+        vals.append(int(limit))
+    return conn.execute(query, vals)
+
+
+def _fetch_columns(cursor, arraysize=SEARCH_ARRAYSIZE):
+    # returns the column names and a list of values per column. rows are fetched as tuples and transposed a
+    # batch at a time, so no Row is created
+    cursor.row_factory = None
+    cursor.arraysize = arraysize
+    names = [d[0] for d in cursor.description]
+    values = [[] for _ in names]
+    try:
+        while True:
+            rows = cursor.fetchmany()
+            if len(rows) == 0:
+                break
+            for column, batch in zip(values, zip(*rows)):
+                column.extend(batch)
+    finally:
+        cursor.close()
+    return names, values
+
+
+def _column_kind(values):
+    # the type of a column of values and whether it has nulls. columns are NUMERIC, so they mostly hold a single
+    # type, but nulls are common. the type is int, float (any numbers), str, bytes or object
+    types = set(map(type, values))
+    nulls = type(None) in types
+    types.discard(type(None))
+    if types == {int}:
+        return 'int', nulls
+    elif len(types) > 0 and types <= {int, float}:
+        return 'float', nulls
+    elif types == {str} or types == {bytes}:
+        return types.pop().__name__, nulls
+    return 'object', nulls
+
+
+def _to_columnar(names, values, as_='numpy'):
+    # envhash is in both tables of a search with environments. only the first is kept
+    columns = collections.OrderedDict()
+    for name, column in zip(names, values):
+        columns.setdefault(name, column)
+    if as_ == 'arrow':
+        import pyarrow as pa
+        types = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string(), 'bytes': pa.binary()}
+        arrays = []
+        for column in columns.values():
+            kind, _ = _column_kind(column)
+            if kind == 'object':
+                # arrow columns have a single type
+                kind, column = 'str', [None if v is None else str(v) for v in column]
+            arrays.append(pa.array(column, type=types[kind]))
+        return pa.Table.from_arrays(arrays, names=list(columns))
+    import numpy as np
+    arrays = collections.OrderedDict()
+    for name, column in columns.items():
+        kind, nulls = _column_kind(column)
+        if kind == 'int' and not nulls:
+            arrays[name] = np.array(column, dtype=np.int64)
+        elif kind in ('int', 'float'):
+            # nulls become nan
+            arrays[name] = np.array(column, dtype=np.float64)
+        else:
+            arrays[name] = np.empty(len(column), dtype=object)
+            arrays[name][:] = column
+    if as_ == 'pandas':
+        import pandas as pd
+        return pd.DataFrame(arrays, copy=False)
+    return arrays
+
+
+def _iter_cursor(cursor, arraysize=SEARCH_ARRAYSIZE):
+    cursor.arraysize = arraysize
+    try:
+        while True:
+            rows = cursor.fetchmany()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+def search_envs(metadata, conn=None, db='files.db', wd='.', timeout=10, verbose=False, keys_to_print=None, parse_exclamation=False,
+                columns=None, order_by=None, limit=None, after=None, profile=None):
+    # columns, order_by, limit and after are as in search, with envhash in place of filename
     if conn is None:
-        if not os.path.exists(os.path.join(wd, db)):
-            raise FileNotFoundError('{} does not exist in {}'.format(db, wd))
-        conn = _get_conn(db, wd, timeout=timeout)
-    basestr = 'select * from environments'
+        conn = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).conn
+    expr, vals = '', []
     if len(metadata) > 0:
         expr, vals = _make_expression_vals({}, metadata)
-        query_string = basestr + ' where ' + expr
-        rows = conn.execute(query_string, vals).fetchall()
-    else:
-        rows = conn.execute(basestr).fetchall()
+    rows = _select_cursor(conn, 'environments', ['environments'], 'envhash', expr, vals, columns=columns,
+                          order_by=order_by, limit=limit, after=after).fetchall()
     if verbose:
         _print_rows(rows, keys=keys_to_print)
     return RowList(rows)
 
 
+def _sort_key(value):
+    # the order of sqlite. nulls, then numbers, text and blobs
+    if value is None:
+        return 0, 0
+    elif isinstance(value, (int, float)):
+        return 1, value
+    elif isinstance(value, str):
+        return 2, value
+    return 3, value
+
+
+def _summary_cursor(conn, group_by, where=None, aggregate=None, environment=None):
+    # aggregate maps column names to an aggregate function or a list of them. the results are in columns named
+    # function_column
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    fromstr, tables = _from_clause(environment=environment)
+    expr, vals = _where_clause(where or {}, conn, environment=environment)
+    refs = [_column_ref(conn, tables, c) for c in group_by]
+    selects = refs + ['count(*) as count']
+    for column, functions in (aggregate or {}).items():
+        for function in [functions] if isinstance(functions, str) else functions:
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError('unsupported aggregate function {}'.format(function))
+            selects.append('{}({}) as {}'.format(function, _column_ref(conn, tables, column),
+                                                 _quote_single('{}_{}'.format(function, column))))
+    query = 'select {} from {}'.format(', '.join(selects), fromstr)
+    if expr:
+        query += ' where ' + expr
+    if len(refs) > 0:
+        query += ' group by {refs} order by {refs}'.format(refs=', '.join(refs))
+    return conn.execute(query, vals)
+
+
+def summary(group_by, where=None, db='files.db', wd='.', timeout=10, aggregate=None, environment=None, profile=None):
+    # the number of files for each combination of values of the group_by columns among the files matching
+    # where, and aggregates of other columns, e.g., aggregate={'time': ['min', 'max']}
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).summary(
+        group_by, where=where, aggregate=aggregate, environment=environment)
+
+
+def distinct(column, where=None, db='files.db', wd='.', timeout=10, environment=None, profile=None):
+    # the sorted distinct values of column among the files matching where
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).distinct(
+        column, where=where, environment=environment)
+
+
+def coverage(row_column, column_column, where=None, db='files.db', wd='.', timeout=10, environment=None, profile=None):
+    # the number of files for each pair of values of two columns. returns the values of the two columns and a
+    # matrix (list of lists) of counts, which are 0 for missing combinations
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).coverage(
+        row_column, column_column, where=where, environment=environment)
+
+
+def _record_search(conn, metadata):
+    stats = getattr(conn, 'search_stats', None)
+    if stats is None:
+        return
+    # only equality comparisons can use all the columns of an index. filename is already the primary key
+    columns = set()
+    for key in metadata.keys():
+        key, op = _parse_key(key)
+        if op in ['=', 'in'] and key != 'filename':
+            columns.add(key)
+    if len(columns) > 0:
+        stats[','.join(sorted(columns))] += 1
+
+
+def _flush_search_stats_incontext(conn):
+    stats = getattr(conn, 'search_stats', None)
+    if not stats:
+        return
+    items = list(stats.items())
+    conn.executemany('insert or ignore into search_stats (columns, count) values (?, 0)', [(c,) for c, _ in items])
+    conn.executemany('update search_stats set count = count + ? where columns = ?', [(n, c) for c, n in items])
+    stats.clear()
+
+
+def _index_name(columns):
+    return INDEX_PREFIX + ','.join(columns)
+
+
+def _create_index_incontext(conn, columns):
+    columns = list(columns)
+    if len(columns) == 0:
+        raise ValueError('at least one column is required to create an index')
+    existing = _table_columns(conn, 'filelist', validate=True)
+    for column in columns:
+        if column not in existing:
+            raise ValueError('column {} does not exist'.format(column))
+    conn.execute('create index if not exists {} on filelist ({})'.format(_quote_single(_index_name(columns)),
+                                                                         ', '.join(_quote(columns))))
+
+
+def _drop_index_incontext(conn, columns):
+    # an empty list of columns drops every index created by filesdb
+    if len(columns) == 0:
+        names = [name for name, _ in _managed_indexes(conn)]
+    else:
+        names = [_index_name(columns)]
+    for name in names:
+        conn.execute('drop index if exists {}'.format(_quote_single(name)))
+
+
+def _managed_indexes(conn):
+    names = [r[0] for r in conn.execute("select name from sqlite_master where type = 'index' and tbl_name = 'filelist'")]
+    return [(name, [r[2] for r in conn.execute('pragma index_info({})'.format(_quote_single(name)))])
+            for name in names if name.startswith(INDEX_PREFIX)]
+
+
+def _list_indexes(conn, min_count=AUTO_INDEX_MIN_COUNT):
+    indexes = {','.join(columns): name for name, columns in _managed_indexes(conn)}
+    stats = dict(conn.execute('select columns, count from search_stats').fetchall())
+    out = []
+    for columns in sorted(set(indexes) | set(stats), key=lambda c: (-stats.get(c, 0), c)):
+        out.append({'columns': columns,
+                    'searches': stats.get(columns, 0),
+                    'index': indexes.get(columns),
+                    'recommended': columns not in indexes and stats.get(columns, 0) >= min_count})
+    return out
+
+
 def _cmprows(r1, r2):
     r1 = dict(r1)
     r2 = dict(r2)
-    for k in (set(r1.keys()) | set(r2.keys())):
+    # checksums describe the file rather than the entry
+    for k in (set(r1.keys()) | set(r2.keys())) - set(CHECKSUM_KEYS):
         if r1.get(k) != r2.get(k):
             return False
     return True
 
 
-def merge(indb, outdb, wd='.', timeout=10):
-    rowsin = search({}, db=indb, wd=wd)
-    envrowsin = search_envs({}, db=indb, wd=wd)
-    rowsout = search({}, db=outdb, wd=wd)
-    rowsoutdict = {r['filename']: r for r in rowsout}
-    fnamesout = {r['filename'] for r in rowsout}
-    rowsindict = {r['filename']: r for r in rowsin}
-    envrowsindict = {r['envhash']: r for r in envrowsin}
-    outenvhashes = {r['envhash'] for r in rowsout}
+def _select_in(conn, table, column, values):
+    # select the rows whose column is in values, through a join with a temporary table. within a transaction,
+    # the keys are written as part of it, otherwise they are committed right away so no lock is held
+    with contextlib.ExitStack() as stack:
+        if not conn.in_transaction:
+            stack.enter_context(conn)
+        conn.execute('create temp table if not exists filesdb_keys (key primary key)')
+        conn.execute('delete from temp.filesdb_keys')
+        conn.executemany('insert or ignore into temp.filesdb_keys values (?)', [(v,) for v in values])
+    return RowList(conn.execute('select {table}.* from {table} join temp.filesdb_keys on {table}.{column} = '
+                                'filesdb_keys.key'.format(table=table, column=_quote_single(column))).fetchall())
 
-    metadatalist = []
-    newenvhashes = set()
-    envdatalist = []
-    for fname, row in rowsindict.items():
-        if fname in fnamesout:
-            if not _cmprows(row, rowsoutdict[fname]):
-                raise RuntimeError('{} detected in output database, but with different rows'.format(fname))
-        else:
-            metadatalist.append(dict(row))
-            if row['envhash'] not in outenvhashes and row['envhash'] not in newenvhashes:
-                newenvhashes.add(row['envhash'])
-                envdatalist.append(dict(envrowsindict[row['envhash']]))
-    conn = _get_conn(outdb, wd, timeout=timeout)
-    with conn:
-        _add_many_incontext(metadatalist, conn)
-        _add_many_incontext(envdatalist, conn, tablename='environments')
-
-
-def copy(filename, outdir, db='files.db', wd='.', outdb='files.db', copytype='copy'):
-    rowin = search({'filename': filename}, db=db, wd=wd)
-    assert len(rowin) == 1
-    rowin = rowin[0]
-    if rowin['envhash'] is not None:
-        envin = search_envs({'envhash': rowin['envhash']}, wd=wd, db=db)
-        assert len(envin) == 1
-        envin = dict(envin[0])
-    else:
-        envin = None
+
+def _indexed_columns(conn, table):
+    columns = set()
+    for index in conn.execute('pragma index_list({})'.format(table)).fetchall():
+        columns.update(row['name'] for row in conn.execute('pragma index_info({})'.format(_quote_single(index['name']))))
+    return columns
+
+
+def _database_size(conn):
+    return conn.execute('pragma page_count').fetchone()[0] * conn.execute('pragma page_size').fetchone()[0]
+
+
+def _remove_files(filenames, wd, jobs=None):
+    # remove the files in jobs threads. returns the errors by file name. missing files are not errors
+    def remove(filename):
+        try:
+            os.remove(os.path.join(wd, filename))
+        except FileNotFoundError:
+            pass
+
+    errors = {}
+    if len(filenames) == 0:
+        return errors
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(remove, filename): filename for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+    return errors
+
+
+def _move_files(filenames, src, dst, jobs=None):
+    # rename the files from src to dst in jobs threads. returns the errors by file name. missing files are not
+    # errors, but existing files in dst are
+    def move(filename):
+        path = os.path.join(dst, filename)
+        if os.path.lexists(path):
+            raise FileExistsError('{} already exists'.format(path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.rename(os.path.join(src, filename), path)
+        except FileNotFoundError:
+            pass
+
+    errors = {}
+    if len(filenames) == 0:
+        return errors
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(move, filename): filename for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+    return errors
+
+
+def _write_manifest(conn, rows, batchdir):
+    # save the rows and their environments in a new database in batchdir
+    os.makedirs(os.path.join(batchdir, 'files'))
+    envrows = _select_in(conn, 'environments', 'envhash', {r['envhash'] for r in rows if r['envhash'] is not None})
+    with Database(TRASH_MANIFEST, batchdir) as manifest:
+        with _transaction(manifest.conn):
+            _add_many_incontext([dict(r) for r in rows], manifest.conn)
+            _add_many_incontext([dict(r) for r in envrows], manifest.conn, tablename='environments')
+
+
+def _read_manifest(batchdir):
+    uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(os.path.join(batchdir, TRASH_MANIFEST))))
+    conn = sqlite3.connect(uri, uri=True)
     try:
-        row = search({'filename': filename}, db=outdb, wd=outdir)
-    except FileNotFoundError:
-        add(dict(rowin), db=outdb, wd=outdir, copy_mode=True, environment=envin)
-    else:
-        if len(row) > 1:
-            raise RuntimeError('multiple entries found. this should be impossible')
-        elif len(row) == 1:
-            if not _cmprows(row[0], rowin):
-                raise RuntimeError('filename already appears in output database, but with different parameters')
-        else:
-            add(dict(rowin), db=outdb, wd=outdir, copy_mode=True, environment=envin)
-    outfull = os.path.join(outdir, filename)
-    infull = os.path.join(wd, filename)
+        conn.row_factory = Row
+        return RowList(conn.execute('select * from filelist').fetchall())
+    finally:
+        conn.close()
+
+
+def _list_trash(wd='.'):
+    trashdir = os.path.join(wd, TRASH_DIR)
+    if not os.path.isdir(trashdir):
+        return []
+    out = []
+    for batch in sorted(os.listdir(trashdir)):
+        manifest = os.path.join(trashdir, batch, TRASH_MANIFEST)
+        if os.path.exists(manifest):
+            mtime = os.stat(manifest).st_mtime
+            out.append({'batch': batch, 'deleted': datetime.datetime.fromtimestamp(mtime).isoformat(' ', 'seconds'),
+                        'age': time.time() - mtime, 'files': len(_read_manifest(os.path.join(trashdir, batch)))})
+    return out
+
+
+def _hash_file(path, algorithm=CHECKSUM_ALGORITHM):
+    # returns the hex digest, size and modification time of the file
+    st = os.stat(path)
+    h = hashlib.new(algorithm)
+    buf = bytearray(CHECKSUM_BUFSIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest(), st.st_size, st.st_mtime_ns
+
+
+def _hash_files(filenames, wd, algorithm=CHECKSUM_ALGORITHM, jobs=None):
+    # hash the files in jobs processes. yields (filename, (digest, size, mtime), exception)
+    if len(filenames) == 0:
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_hash_file, os.path.join(wd, filename), algorithm): filename
+                   for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def _stored_digest(row, path):
+    # the recorded checksum of the row, if the file has not been modified since it was hashed
+    row = dict(row)
+    if row.get('checksum') is None:
+        return None
+    st = os.stat(path)
+    if st.st_size != row['checksum_size'] or st.st_mtime_ns != row['checksum_mtime']:
+        return None
+    return row['checksum_algorithm'], row['checksum']
+
+
+def _files_equal(path1, path2, compare='content', digests=None):
+    # digests is a pair of known content digests (or None) of the two files
+    if compare not in COMPARE_MODES:
+        raise ValueError('unsupported compare mode {}'.format(compare))
+    if os.path.samefile(path1, path2):
+        return True
+    st1 = os.stat(path1)
+    st2 = os.stat(path2)
+    if st1.st_size != st2.st_size:
+        return False
+    if compare == 'stat' and st1.st_mtime_ns == st2.st_mtime_ns:
+        return True
+    if digests is not None and None not in digests:
+        return digests[0] == digests[1]
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            b1 = f1.read(COMPARE_BUFSIZE)
+            if b1 != f2.read(COMPARE_BUFSIZE):
+                return False
+            if not b1:
+                return True
+
+
+def _copy_file(infull, outfull, copytype='copy', compare='content', row=None, outrow=None):
+    # returns the number of bytes copied, or None if the file was already there. the checksums of row, the input row, and outrow, the row that was
+    # already in the output database, if any, are used to compare the files
     if os.path.exists(outfull):
-        if not filecmp.cmp(outfull, infull, shallow=False):
+        digests = None
+        if row is not None and outrow is not None:
+            digests = (_stored_digest(outrow, outfull), _stored_digest(row, infull))
+        if not _files_equal(outfull, infull, compare=compare, digests=digests):
             raise RuntimeError('File already copied, but results not identical')
+        return None
+    if copytype == 'hardlink':
+        os.link(infull, outfull)
+        return 0
+    elif copytype == 'copy':
+        shutil.copyfile(infull, outfull)
+        # keep the modification time, so compare='stat' can recognize the copy
+        st = os.stat(infull)
+        os.utime(outfull, ns=(st.st_atime_ns, st.st_mtime_ns))
+        return st.st_size
     else:
-        if copytype == 'hardlink':
-            os.link(infull, outfull)
-        elif copytype == 'copy':
-            shutil.copyfile(infull, outfull)
-        else:
-            raise ValueError('unsupported copytype')
+        raise ValueError('unsupported copytype')
 
 
-def delete(metadata, db='files.db', wd='.', timeout=10, dryrun=False, delimiter='\t'):
-    if not os.path.exists(os.path.join(wd, db)):
-        raise FileNotFoundError('{} does not exist in {}'.format(db, wd))
-    if len(metadata) == 0:
-        raise ValueError('must have at least one search parameter')
-    conn = _get_conn(db, wd, timeout=timeout)
-    with conn:
-        rows = search(metadata, conn)
-        if len(rows) > 0:
-            if not dryrun:
-                for r in rows:
-                    if os.path.exists(os.path.join(wd, r['filename'])):
-                        os.remove(os.path.join(wd, r['filename']))
-                    # potential race condition here, but delete should not be called often
-                    # and it should be called directly (not in a script) so the user can
-                    # keep track of potential issues.
-                    conn.execute('delete from filelist where filename=?', (r['filename'],))
-    return RowList(rows)
+def merge(indb, outdb, wd='.', timeout=10, profile=None):
+    return _get_database(outdb, wd, timeout=timeout, profile=profile).merge(indb)
+
+
+@contextlib.contextmanager
+def _attached(conn, path, schema):
+    conn.execute('attach database ? as {}'.format(schema), (path,))
+    try:
+        yield
+    finally:
+        conn.execute('detach database {}'.format(schema))
+
+
+def _read_schema(path):
+    conn = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(path))), uri=True)
+    try:
+        return {table: _query_columns(conn, table) for table in ('filelist', 'environments')}
+    finally:
+        conn.close()
+
+
+def _merge_attached_incontext(conn, schema, on_conflict='raise'):
+    # merge the filelist and environments tables of the attached database into main. rows whose filename is
+    # already in main are skipped if identical and are conflicts otherwise. returns the row counts
+    counts = {'inserted': 0, 'skipped': 0, 'conflicts': 0}
+    columns = sorted(_query_columns(conn, 'filelist', schema=schema))
+    if len(columns) == 0:
+        return counts
+    _update_columns_incontext(conn, 'filelist', columns)
+    envcolumns = sorted(_query_columns(conn, 'environments', schema=schema))
+    _update_columns_incontext(conn, 'environments', envcolumns)
+
+    # columns missing from the input are null, so they must be null in main for rows to match. metahash is
+    # derived from the other columns and is missing from old inputs until it is backfilled
+    same = ' and '.join(['m.{col} is {val}'.format(col=_quote_single(c), val='s.' + _quote_single(c) if c in columns else 'null')
+                         for c in sorted(_table_columns(conn, 'filelist')) if c not in CHECKSUM_KEYS + ('metahash',)])
+    conflicts = 'from {}.filelist s join main.filelist m on m.filename = s.filename where not ({})'.format(schema, same)
+    if on_conflict == 'raise':
+        row = conn.execute('select s.filename ' + conflicts + ' limit 1').fetchone()
+        if row is not None:
+            raise RuntimeError('{} detected in output database, but with different rows'.format(row[0]))
+    elif on_conflict == 'skip':
+        counts['conflicts'] = conn.execute('select count(*) ' + conflicts).fetchone()[0]
+    else:
+        raise ValueError('unsupported on_conflict')
+
+    new_rows = 'from {}.filelist s where not exists (select 1 from main.filelist m where m.filename = s.filename)'.format(schema)
+    if len(envcolumns) > 0 and 'envhash' in columns:
+        cols = ', '.join(_quote(envcolumns))
+        conn.execute('insert into main.environments ({cols}) select {cols} from {schema}.environments e '
+                     'where e.envhash in (select s.envhash {new_rows}) '
+                     'and not exists (select 1 from main.environments m where m.envhash = e.envhash)'.format(
+                         cols=cols, schema=schema, new_rows=new_rows))
+    cols = ', '.join(_quote(columns))
+    total = conn.execute('select count(*) from {}.filelist'.format(schema)).fetchone()[0]
+    counts['inserted'] = conn.execute('insert into main.filelist ({cols}) select {scols} {new_rows}'.format(
+        cols=cols, scols=', '.join('s.' + c for c in _quote(columns)), new_rows=new_rows)).rowcount
+    counts['skipped'] = total - counts['inserted'] - counts['conflicts']
+    _backfill_metahash_incontext(conn)
+    return counts
+
+
+def merge_many(indbs, outdb, wd='.', timeout=10, on_conflict='raise', jobs=None, profile=None):
+    # merge each input database in turn. on_conflict='skip' counts conflicting rows instead of raising.
+    # jobs is the number of threads used to read the input schemas. returns the row counts for each input
+    database = _get_database(outdb, wd, timeout=timeout, profile=profile)
+    return database.merge_many(indbs, on_conflict=on_conflict, jobs=jobs)
+
+
+def copy(filename, outdir, db='files.db', wd='.', outdb='files.db', copytype='copy', timeout=10, compare='content',
+         profile=None):
+    database = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile)
+    database.copy(filename, outdir, outdb=outdb, copytype=copytype, compare=compare)
+
+
+def copy_many(filenames_or_query, outdir, db='files.db', wd='.', outdb='files.db', copytype='copy', jobs=None, timeout=10,
+              compare='content', profile=None):
+    # copy a list of files, or the files matching a search, with their rows. the rows are added to outdb in one
+    # transaction and the files are copied by jobs threads. errors for individual files are collected and
+    # returned with the number of files and bytes copied and the time taken
+    database = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile)
+    return database.copy_many(filenames_or_query, outdir, outdb=outdb, copytype=copytype, jobs=jobs, compare=compare)
+
+
+def import_catalog(infile, db='files.db', wd='.', timeout=10, fmt=None, copy_mode=False, environment=None,
+                   chunksize=IMPORT_CHUNKSIZE, ext='', prefix='', suffix='', profile=None):
+    # add one file per row of a csv or json lines file (- for stdin). fmt is guessed from the extension if not
+    # given. rows are read and added chunksize at a time, each chunk in one transaction, so a failed import
+    # leaves the earlier chunks. copy_mode keeps the filename, time and envhash of each row, as in an export.
+    # returns the number of rows added
+    return _get_database(db, wd, timeout=timeout, profile=profile).import_catalog(
+        infile, fmt=fmt, copy_mode=copy_mode, environment=environment, chunksize=chunksize, ext=ext, prefix=prefix,
+        suffix=suffix)
+
+
+def export_catalog(outfile, metadata=None, db='files.db', wd='.', timeout=10, fmt=None, environment=None, profile=None):
+    # write the files matching the search, with their environments, to a csv or json lines file (- for stdout).
+    # returns the number of rows written
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).export_catalog(
+        outfile, metadata=metadata, fmt=fmt, environment=environment)
+
+
+def checksum(metadata, db='files.db', wd='.', timeout=10, algorithm=CHECKSUM_ALGORITHM, jobs=None, force=False,
+             profile=None):
+    # hash the files matching the search that have no checksum yet (all of them if force) in jobs processes,
+    # and record the digests. returns the number of files and bytes hashed, the time taken and the errors
+    database = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile)
+    return database.checksum(metadata, algorithm=algorithm, jobs=jobs, force=force)
+
+
+def verify(metadata, db='files.db', wd='.', timeout=10, jobs=None, profile=None):
+    # check the files matching the search against their checksums. files whose size and modification time are
+    # unchanged are not read. returns lists of ok, changed, missing and unchecked file names
+    database = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile)
+    return database.verify(metadata, jobs=jobs)
+
+
+def index(db='files.db', wd='.', timeout=10, create=None, drop=None, auto=False, min_count=AUTO_INDEX_MIN_COUNT, profile=None):
+    # create and drop take a list of columns. drop=[] drops every index created by filesdb. auto creates
+    # indexes for column sets searched at least min_count times. returns the indexes and search statistics
+    database = _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile)
+    return database.index(create=create, drop=drop, auto=auto, min_count=min_count)
+
+
+def delete(metadata, db='files.db', wd='.', timeout=10, dryrun=False, delimiter='\t', jobs=None, trash=False,
+           profile=None):
+    # the files are removed by jobs threads. files that could not be removed are in the errors attribute of the
+    # returned rows. with trash, the files are moved to the trash instead, and the batch attribute of the rows
+    # can be passed to undelete
+    try:
+        return _server_call(db, wd, 'delete', metadata=metadata, dryrun=dryrun, jobs=jobs, trash=trash)
+    except _NoServer:
+        pass
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).delete(metadata, dryrun=dryrun,
+                                                                                           jobs=jobs, trash=trash)
+
+
+def maintain(db='files.db', wd='.', timeout=10, drop_columns=False, vacuum='incremental', profile=None):
+    # remove environments no longer used by any file, optionally drop columns that are null in every row, and
+    # update the statistics of the query planner and vacuum. vacuum is 'incremental', 'full' or None. returns
+    # the number of environments and the columns removed, the size of the database before and after, and the
+    # time taken by each step
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).maintain(
+        drop_columns=drop_columns, vacuum=vacuum)
+
+
+def undelete(batch, db='files.db', wd='.', timeout=10, jobs=None, profile=None):
+    # restore the entries and files of a delete(trash=True) batch. returns the restored rows
+    return _get_database(db, wd, timeout=timeout, must_exist=True, profile=profile).undelete(batch, jobs=jobs)
+
+
+def purge(wd='.', older_than=0, dryrun=False, jobs=None):
+    # permanently remove the trash batches that were deleted at least older_than seconds ago. returns the
+    # batches, with the number of files that could not be removed
+    out = []
+    for batch in _list_trash(wd):
+        if batch['age'] < older_than:
+            continue
+        batchdir = os.path.join(wd, TRASH_DIR, batch['batch'])
+        errors = {}
+        if not dryrun:
+            errors = _remove_files([r['filename'] for r in _read_manifest(batchdir)], os.path.join(batchdir, 'files'),
+                                   jobs=jobs)
+            if len(errors) == 0:
+                shutil.rmtree(batchdir)
+        batch['errors'] = len(errors)
+        out.append(batch)
+    return out
+
+
+def _parse_duration(duration):
+    # seconds, or a number followed by s, m, h or d
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if duration[-1:] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
 
 
 def _parse_metadata(metadatalist):
     metadata = {}
     for entry in metadatalist:
-        split_entry = entry.split('=')
-        if len(split_entry) != 2:
+        match = re.match('^(.+?)(!=|<=|>=|<|>|=)(.*)$', entry)
+        if match is None or '=' in match.group(3):
             raise ValueError('invalid metadata term: {}'.format(entry))
-        key, val = split_entry
-        val.strip()
-        if val == 'None':
+        key, op, val = match.groups()
+        key = key.strip() + _CMD_OPS[op]
+        if _parse_key(key)[1] in _LIST_OPS:
+            # comma separated values
+            val = [None if v == 'None' else v for v in val.split(',')]
+        elif val == 'None':
             val = None
-        metadata[key.strip()] = val
+        metadata[key] = val
 
     return metadata
 
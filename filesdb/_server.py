@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import os
+import socket
+import socketserver
+import threading
+
+from ._filesdb import RowList, _dumps, _loads, _rows_to_wire, _socket_path, _SERVER_ERRORS
+from ._worker import Worker
+
+
+__all__ = ['serve']
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = _loads(line)
+                response = self._run(request['op'], request.get('kwargs', {}))
+                self.wfile.write(_dumps(response))
+            except Exception as e:
+                self.wfile.write(_dumps({'error': type(e).__name__, 'message': str(e)}))
+            self.wfile.flush()
+
+    def _run(self, op, kwargs):
+        done = threading.Event()
+        response = {}
+
+        def callback(result, exc):
+            if exc is None:
+                response['result'] = _rows_to_wire(result) if isinstance(result, RowList) else result
+            else:
+                name = type(exc).__name__
+                response['error'] = name if name in _SERVER_ERRORS else 'RuntimeError'
+                response['message'] = str(exc)
+            done.set()
+
+        self.server.worker.submit(op, kwargs, callback)
+        done.wait()
+        return response
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, db='files.db', wd='.', timeout=10, profile=None, batch_time=0.01, batch_size=1000):
+        self.path = _socket_path(db, wd)
+        if os.path.exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                # left behind by a server that did not shut down cleanly
+                os.remove(self.path)
+            else:
+                raise RuntimeError('a server is already running for {}'.format(os.path.join(wd, db)))
+            finally:
+                sock.close()
+        self.worker = Worker(db, wd, timeout=timeout, profile=profile, batch_time=batch_time, batch_size=batch_size)
+        self.worker.start()
+        try:
+            socketserver.UnixStreamServer.__init__(self, self.path, _Handler)
+            os.chmod(self.path, 0o600)
+        except Exception:
+            self.worker.stop()
+            raise
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.worker.stop()
+
+
+def serve(db='files.db', wd='.', timeout=10, profile=None, batch_time=0.01, batch_size=1000):
+    # serve add, add_many, search and delete requests for the database on a unix socket next to it until
+    # interrupted. adds are committed in batches, once batch_time seconds have passed since the first one
+    # or batch_size rows are waiting
+    server = _Server(db, wd, timeout=timeout, profile=profile, batch_time=batch_time, batch_size=batch_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+
+import queue
+import sqlite3
+import threading
+import time
+
+from ._filesdb import (Database, _add_incontext, _add_metadata_many_incontext, _flush_search_stats_incontext,
+                       _transaction)
+
+
+# requests that are grouped into a single transaction. each is run in its own savepoint, so a failing
+# request does not affect the others
+_BATCHED_OPS = {'add': _add_incontext, 'add_many': _add_metadata_many_incontext}
+_DIRECT_OPS = 'search', 'search_envs', 'delete', 'merge', 'index'
+_STOP = object()
+
+
+def _batch_rows(op, kwargs):
+    return len(kwargs['metadatalist']) if op == 'add_many' else 1
+
+
+class Worker(threading.Thread):
+    # A thread that owns the connection to one database and runs requests in the order they are submitted.
+    # Consecutive adds are committed together once batch_time seconds have passed since the first one, or
+    # batch_size rows are waiting.
+
+    def __init__(self, db='files.db', wd='.', timeout=10, profile=None, batch_time=0.01, batch_size=1000):
+        super(Worker, self).__init__(daemon=True)
+        self.db = db
+        self.wd = wd
+        self.timeout = timeout
+        self.profile = profile
+        self.batch_time = batch_time
+        self.batch_size = batch_size
+        self.commits = 0
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        super(Worker, self).start()
+        # report problems opening the database to the caller
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, op, kwargs, callback):
+        # callback is called from the worker thread with (result, exception)
+        if op not in _BATCHED_OPS and op not in _DIRECT_OPS:
+            raise ValueError('unsupported operation {}'.format(op))
+        self._queue.put((op, kwargs, callback))
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self.join()
+
+    def run(self):
+        try:
+            self.database = Database(self.db, self.wd, timeout=self.timeout, profile=self.profile)
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        pending = None
+        try:
+            while True:
+                item = self._queue.get() if pending is None else pending
+                pending = None
+                if item is _STOP:
+                    break
+                if item[0] in _BATCHED_OPS:
+                    batch, pending = self._collect(item)
+                    self._commit(batch)
+                else:
+                    self._call(item)
+        finally:
+            self.database.close()
+
+    def _collect(self, item):
+        # returns the batch and the request that ended it, if any
+        batch = [item]
+        rows = _batch_rows(item[0], item[1])
+        deadline = time.time() + self.batch_time
+        while rows < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP or item[0] not in _BATCHED_OPS:
+                return batch, item
+            batch.append(item)
+            rows += _batch_rows(item[0], item[1])
+        return batch, None
+
+    def _commit(self, batch):
+        conn = self.database.conn
+        results = []
+        try:
+            with _transaction(conn):
+                _flush_search_stats_incontext(conn)
+                for op, kwargs, _ in batch:
+                    conn.execute('savepoint request')
+                    try:
+                        results.append((_BATCHED_OPS[op](conn=conn, **kwargs), None))
+                    except Exception as e:
+                        conn.execute('rollback to request')
+                        conn._invalidate()
+                        results.append((None, e))
+                    conn.execute('release request')
+            self.commits += 1
+        except sqlite3.Error as e:
+            results = [(None, e)] * len(batch)
+        for (_, _, callback), (result, exc) in zip(batch, results):
+            callback(result, exc)
+
+    def _call(self, item):
+        op, kwargs, callback = item
+        try:
+            result = getattr(self.database, op)(**kwargs)
+        except Exception as e:
+            callback(None, e)
+        else:
+            callback(result, None)
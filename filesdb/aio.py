@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+
+import asyncio
+import atexit
+import os
+import threading
+
+from ._filesdb import Database, SEARCH_ARRAYSIZE, _search_cursor
+from ._worker import Worker
+
+
+__all__ = ['add', 'add_many', 'iter_search', 'merge', 'search']
+
+
+# seconds the worker waits for more adds before committing. adds from coroutines that are queued while the
+# previous transaction commits are always committed together
+BATCH_TIME = 0
+
+# one worker thread per database
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def _get_worker(db, wd, timeout=10, profile=None):
+    key = (os.path.abspath(os.path.join(wd, db)), timeout, profile)
+    with _workers_lock:
+        worker = _workers.get(key)
+        if worker is None or not worker.is_alive():
+            worker = _workers[key] = Worker(db, wd, timeout=timeout, profile=profile, batch_time=BATCH_TIME)
+            worker.start()
+    return worker
+
+
+def _stop_workers():
+    with _workers_lock:
+        for worker in _workers.values():
+            if worker.is_alive():
+                worker.stop()
+        _workers.clear()
+
+
+atexit.register(_stop_workers)
+
+
+def _set_result(future, result, exc):
+    if future.cancelled():
+        return
+    if exc is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exc)
+
+
+async def _submit(worker, op, **kwargs):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    worker.submit(op, kwargs, lambda result, exc: loop.call_soon_threadsafe(_set_result, future, result, exc))
+    return await future
+
+
+def _check_exists(db, wd):
+    if not os.path.exists(os.path.join(wd, db)):
+        raise FileNotFoundError('{} does not exist in {}'.format(db, wd))
+
+
+async def add(metadata, db='files.db', wd='.', filename=None, timeout=10, ext='', prefix='', suffix='', copy_mode=False,
+              environment=None, profile=None):
+    return await _submit(_get_worker(db, wd, timeout=timeout, profile=profile), 'add', metadata=metadata,
+                         filename=filename, ext=ext, prefix=prefix, suffix=suffix, copy_mode=copy_mode,
+                         environment=environment)
+
+
+async def add_many(metadatalist, db='files.db', wd='.', timeout=10, ext='', prefix='', suffix='', environment=None,
+                   profile=None):
+    return await _submit(_get_worker(db, wd, timeout=timeout, profile=profile), 'add_many',
+                         metadatalist=list(metadatalist), ext=ext, prefix=prefix, suffix=suffix, environment=environment)
+
+
+async def search(metadata, db='files.db', wd='.', timeout=10, with_environments=False, environment=None, columns=None,
+                 order_by=None, limit=None, after=None, profile=None):
+    _check_exists(db, wd)
+    return await _submit(_get_worker(db, wd, timeout=timeout, profile=profile), 'search', metadata=metadata,
+                         with_environments=with_environments, environment=environment, columns=columns,
+                         order_by=order_by, limit=limit, after=after)
+
+
+async def merge(indb, outdb, wd='.', timeout=10, profile=None):
+    return await _submit(_get_worker(outdb, wd, timeout=timeout, profile=profile), 'merge', indb=indb)
+
+
+async def iter_search(metadata, db='files.db', wd='.', timeout=10, with_environments=False, environment=None,
+                      arraysize=SEARCH_ARRAYSIZE, columns=None, order_by=None, limit=None, after=None, profile=None):
+    # rows are read arraysize at a time by a thread with its own connection, which waits while the
+    # consumer is two batches behind
+    _check_exists(db, wd)
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+
+    def produce():
+        try:
+            with Database(db, wd, timeout=timeout, profile=profile) as database:
+                cursor = _search_cursor(metadata, database.conn, with_environments=with_environments,
+                                        environment=environment, columns=columns, order_by=order_by, limit=limit,
+                                        after=after)
+                while not stop.is_set():
+                    rows = cursor.fetchmany(arraysize)
+                    put(rows)
+                    if len(rows) == 0:
+                        break
+        except Exception as e:
+            if not stop.is_set():
+                put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            rows = await batches.get()
+            if isinstance(rows, Exception):
+                raise rows
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+    finally:
+        stop.set()
+        # unblock the producer if it is waiting for room in the queue
+        while not batches.empty():
+            batches.get_nowait()
@@ -1,6 +1,8 @@
 from collections import OrderedDict
 import datetime
 import filecmp
+import hashlib
+import json
 import pytest
 import os
 import shutil
@@ -10,12 +12,23 @@ import subprocess
 import filesdb
 from filesdb._filesdb import _make_expression_vals
 from filesdb._filesdb import _hash_metadata
+from filesdb._filesdb import _hash_metadata_many
+from filesdb._filesdb import _hash_environment
 from filesdb._filesdb import _parse_metadata
 from filesdb._filesdb import _cmprows
 from filesdb._filesdb import _add_many_incontext
 from filesdb._filesdb import _get_conn
+from filesdb._filesdb import _get_database
+from filesdb._filesdb import _transaction
+from filesdb._filesdb import _add_incontext
 from filesdb._filesdb import _update_columns_incontext
+from filesdb._filesdb import _query_columns
 from filesdb._filesdb import _add_environment_incontext
+from filesdb._filesdb import _files_equal
+from filesdb._filesdb import _copy_file
+from filesdb._filesdb import _fetch_columns
+from filesdb._filesdb import _column_kind
+from filesdb._filesdb import _search_cursor
 
 
 def test_file_exists(tmpdir):
@@ -243,6 +256,40 @@ def test_hash():
     assert h7 == h3
 
 
+def _reference_hash_metadata(metadata, envhash=None):
+    # _hash_metadata as originally written. file names depend on it, so it must never change
+    keys = list(metadata.keys())
+    keys.sort()
+    h = hashlib.sha256()
+    for k in keys:
+        h.update(bytes(str(k), 'utf-8'))
+        val = metadata[k]
+        if isinstance(val, str):
+            try:
+                val = float(val)
+            except ValueError:
+                pass
+        elif isinstance(val, int):
+            val = float(val)
+        h.update(bytes(str(val), 'utf-8'))
+    if envhash is not None:
+        h.update(bytes(str(envhash), 'utf-8'))
+    return h.hexdigest()
+
+
+def test_hash_compat():
+    values = [0, 1, -1, 2**60, True, False, 0.0, -0.0, 1.5, 1e300, float('nan'), '2', '2.0', ' 2 ', '1e3', 'nan',
+              '-inf', 'abc', '', 'ünïcode', b'bytes', None]
+    metadatalist = [{'a': v} for v in values] + [{'b': v, 'a': w, 'c': 'x'} for v in values for w in values[::3]]
+    envhashes = [None, 'abc'] * (len(metadatalist) // 2) + [None] * (len(metadatalist) % 2)
+    expected = [_reference_hash_metadata(m, envhash=e) for m, e in zip(metadatalist, envhashes)]
+    assert [_hash_metadata(m, envhash=e) for m, e in zip(metadatalist, envhashes)] == expected
+    assert _hash_metadata_many(metadatalist, envhashes) == expected
+    # twice, to use the caches
+    for _ in range(2):
+        assert [_hash_environment(m) for m in metadatalist] == [_reference_hash_metadata(m) for m in metadatalist]
+
+
 def test_cmd(tmpdir):
     subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(str(tmpdir)), 'add', 'field1=one', 'field2=2'])
     assert subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(str(tmpdir)), 'search']).decode().count('\n') == 2
@@ -336,6 +383,240 @@ def test_parse_metadata():
         _parse_metadata(['field1=1=3'])
 
 
+def test_parse_metadata_operators():
+    metadata = _parse_metadata(['a<1', 'b<=2', 'c>3', 'd>=4', 'e:in=1,2,None', 'f:between=0.1,0.5', 'g:like=x%',
+                                'h:notin!=1'])
+    assert metadata == {'a<': '1', 'b<=': '2', 'c>': '3', 'd>=': '4', 'e:in': ['1', '2', None], 'f:between': ['0.1', '0.5'],
+                        'g:like': 'x%', 'h:notin!': '1'}
+    with pytest.raises(ValueError):
+        _parse_metadata(['a<=1=2'])
+
+
+def test_search_operators(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(lr=lr, seed=seed, name='run{}'.format(seed)) for lr in [0.05, 0.1, 0.3, 0.5, 0.7]
+                      for seed in range(5)], wd=wd)
+    filesdb.add(dict(lr=0.3), wd=wd)
+    for key in ('x<', 'x>=', 'x:in', 'x:notin', 'x:between', 'x:like', 'x:glob', 'x!'):
+        with pytest.raises(ValueError):
+            filesdb.add({key: 1}, wd=wd)
+        with pytest.raises(ValueError):
+            filesdb.add_many([{key: 1}], wd=wd)
+        with pytest.raises(ValueError):
+            filesdb.add({'a': 1}, wd=wd, environment={key: 1})
+
+    def count(metadata):
+        return len(filesdb.search(metadata, wd=wd))
+
+    assert count({'lr>=': 0.1, 'lr<=': 0.5, 'seed:in': [1, 2, 3]}) == 9
+    assert count({'lr:between': (0.1, 0.5), 'seed:in': {1, 2, 3}}) == 9
+    assert count({'lr>': 0.1, 'lr<': 0.5}) == 6
+    assert count({'seed:in': []}) == 0
+    assert count({'seed:in': [1, None]}) == 6
+    assert count({'seed:notin': [0, 1]}) == 16
+    assert count({'seed:notin': [0, 1, None]}) == 15
+    assert count({'name:like': 'RUN1%'}) == 5
+    assert count({'name:glob': 'RUN1*'}) == 0
+    assert count({'name:glob': 'run[12]'}) == 10
+    assert len(filesdb.search_envs({'envhash:in': ['x']}, wd=wd)) == 0
+    expr, vals = _make_expression_vals({'a:in': [1, 2], 'b<': 3, 'c': None, 'd:between': [4, 5]})
+    assert expr == 'filelist."a" in (?, ?) and filelist."b"<? and filelist."d" between ? and ? and filelist."c" is null'
+    assert vals == [1, 2, 3, 4, 5]
+    with pytest.raises(ValueError):
+        count({'lr<': None})
+    with pytest.raises(ValueError):
+        count({'seed:in': 1})
+    with pytest.raises(ValueError):
+        count({'seed:between': [1]})
+    assert len(filesdb.delete({'lr>': 0.5}, wd=wd)) == 5
+    assert count({}) == 21
+
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'search', '-o', 'lr,seed',
+                                   'lr>=0.3', 'seed:in=1,2']).decode()
+    assert sorted(out.splitlines()[1:]) == ['0.3\t1', '0.3\t2', '0.5\t1', '0.5\t2']
+
+
+def test_search_paging(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(a=i % 4, b=i if i % 3 else None, c=i) for i in range(20)], wd=wd, environment={'git': 1})
+    rows = filesdb.search({}, wd=wd, columns=['a', 'filename'])
+    assert len(rows) == 20
+    assert rows[0].keys() == ['a', 'filename']
+    rows = filesdb.search({}, wd=wd, columns=['a', 'envhash', 'git'], environment={'git': 1})
+    assert rows[0].keys() == ['a', 'envhash', 'git']
+
+    for order_by in ['a', ['-a', 'b'], ['b', '-a'], ['-b'], None]:
+        expected = filesdb.search({}, wd=wd, order_by=order_by)
+        if order_by is None:
+            # pages are in file name order
+            expected = sorted(expected, key=lambda r: r['filename'])
+        pages = []
+        after = None
+        while True:
+            page = filesdb.search({}, wd=wd, order_by=order_by, limit=3, after=after, columns=['filename', 'a', 'b'])
+            if len(page) == 0:
+                break
+            pages.extend(page)
+            after = page[-1] if len(pages) % 2 else page[-1]['filename']
+        assert [r['filename'] for r in pages] == [r['filename'] for r in expected]
+    assert [r['a'] for r in filesdb.search({'a<': 2}, wd=wd, order_by='-a', limit=6)] == [1] * 5 + [0]
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd, order_by='a', after={'filename': 'x'})
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd, after='missing')
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd, columns=['a', 'typo'])
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd, order_by='typo')
+
+    filesdb.add(dict(a=1), wd=wd, environment={'git': 2})
+    assert [r['git'] for r in filesdb.search_envs({}, wd=wd, order_by='-git', columns=['git'], limit=1)] == [2]
+    first = filesdb.search_envs({}, wd=wd, order_by='git', limit=1)[0]
+    assert [r['git'] for r in filesdb.search_envs({}, wd=wd, order_by='git', after=first)] == [2]
+
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'search', '-o', 'a,b',
+                                   '--order_by=-a,b', '--limit=3', 'a!=None']).decode()
+    assert out.splitlines() == ['a\tb', '3\tNone', '3\tNone', '3\t7']
+
+
+def test_summary(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(lr=lr, seed=seed, n=i) for i, (lr, seed) in enumerate(
+        [(0.1, 1), (0.1, 2), (0.2, 1), (0.1, 1), (0.3, None)])], wd=wd, environment={'git': 1})
+    rows = filesdb.summary(['lr', 'seed'], wd=wd, aggregate={'n': ['min', 'max'], 'seed': 'count'})
+    assert [(r['lr'], r['seed'], r['count'], r['min_n'], r['max_n'], r['count_seed']) for r in rows] == [
+        (0.1, 1, 2, 0, 3, 2), (0.1, 2, 1, 1, 1, 1), (0.2, 1, 1, 2, 2, 1), (0.3, None, 1, 4, 4, 0)]
+    assert [r['count'] for r in filesdb.summary([], wd=wd)] == [5]
+    assert [(r['lr'], r['count']) for r in filesdb.summary('lr', where={'seed': 1}, wd=wd)] == [(0.1, 2), (0.2, 1)]
+    assert [(r['git'], r['count']) for r in filesdb.summary(['git'], wd=wd, environment={'git': 1})] == [(1, 5)]
+    with pytest.raises(ValueError):
+        filesdb.summary(['lr'], wd=wd, aggregate={'n': 'median'})
+    with pytest.raises(ValueError):
+        filesdb.summary(['typo'], wd=wd)
+    with pytest.raises(ValueError):
+        filesdb.distinct('typo', wd=wd)
+
+    assert filesdb.distinct('lr', wd=wd) == [0.1, 0.2, 0.3]
+    assert filesdb.distinct('seed', wd=wd) == [None, 1, 2]
+    assert filesdb.distinct('seed', where={'lr>': 0.1}, wd=wd) == [None, 1]
+
+    assert filesdb.coverage('lr', 'seed', wd=wd) == ([0.1, 0.2, 0.3], [None, 1, 2], [[0, 2, 1], [0, 1, 0], [1, 0, 0]])
+
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'summary', '-g', 'lr',
+                                   '-a', 'max:n', 'seed=1']).decode()
+    assert out.splitlines() == ['lr\tcount\tmax_n', '0.1\t2\t3', '0.2\t1\t2']
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'distinct', 'lr']).decode()
+    assert out.splitlines() == ['0.1', '0.2', '0.3']
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'coverage', 'lr', 'seed',
+                                   'seed!=None']).decode()
+    assert out.splitlines() == ['lr\\seed\t1\t2', '0.1\t2\t1', '0.2\t1\t.']
+
+
+def _columnar_db(wd):
+    filesdb.add_many([dict(a=i, b=i / 2 if i % 2 else None, c='x{}'.format(i), d=i if i % 3 else 'none')
+                      for i in range(5)], wd=wd, environment={'git': 1})
+
+
+def test_fetch_columns(tmpdir):
+    wd = str(tmpdir)
+    _columnar_db(wd)
+    conn = _get_database('files.db', wd).conn
+    names, values = _fetch_columns(_search_cursor({}, conn, columns=['a', 'b', 'c', 'd'], order_by='a'), arraysize=2)
+    assert names == ['a', 'b', 'c', 'd']
+    assert values == [[0, 1, 2, 3, 4], [None, 0.5, None, 1.5, None], ['x0', 'x1', 'x2', 'x3', 'x4'],
+                      ['none', 1, 2, 'none', 4]]
+    assert [_column_kind(v) for v in values] == [('int', False), ('float', True), ('str', False), ('object', False)]
+    assert _column_kind([1, None]) == ('int', True)
+    assert _column_kind([None]) == ('object', True)
+    assert _fetch_columns(_search_cursor({'a': 10}, conn, columns=['a']))[1] == [[]]
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd, as_='csv')
+
+
+def test_search_numpy(tmpdir):
+    np = pytest.importorskip('numpy')
+    wd = str(tmpdir)
+    _columnar_db(wd)
+    arrays = filesdb.search({}, wd=wd, order_by='a', as_='numpy')
+    assert arrays['a'].dtype == np.int64
+    assert arrays['b'].dtype == np.float64
+    assert np.isnan(arrays['b'][0]) and arrays['b'][1] == 0.5
+    assert arrays['c'].dtype == object and list(arrays['c']) == ['x0', 'x1', 'x2', 'x3', 'x4']
+    assert list(filesdb.search({}, wd=wd, with_environments=True, as_='numpy').keys()).count('envhash') == 1
+
+
+def test_search_pandas(tmpdir):
+    pytest.importorskip('pandas')
+    wd = str(tmpdir)
+    _columnar_db(wd)
+    df = filesdb.search({'a>': 0}, wd=wd, columns=['a', 'b', 'git'], order_by='a', environment={'git': 1},
+                        as_='pandas')
+    assert list(df.columns) == ['a', 'b', 'git']
+    assert df['a'].tolist() == [1, 2, 3, 4]
+    assert df['b'].isna().tolist() == [False, True, False, True]
+    assert len(filesdb.search({'a': 10}, wd=wd, as_='pandas')) == 0
+
+
+def test_search_arrow(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    wd = str(tmpdir)
+    _columnar_db(wd)
+    table = filesdb.search({}, wd=wd, columns=['a', 'b', 'd'], order_by='a', as_='arrow')
+    assert table.schema.field('a').type == pa.int64()
+    assert table.column('b').null_count == 3
+    assert table.column('d').to_pylist() == ['none', '1', '2', 'none', '4']
+    table = filesdb.search({}, wd=wd, with_environments=True, as_='arrow')
+    assert table.column_names == list(filesdb.search({}, wd=wd, with_environments=True, as_='numpy').keys())
+    assert table.column_names.count('envhash') == 1
+
+
+def test_catalog(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(a=i, b='x' if i % 2 else None) for i in range(5)], wd=wd, environment={'git': 'abc', 'v': 2})
+    filesdb.add(dict(a=9, c=1.5), wd=wd)
+    columns = 'filename, time, envhash, metahash, a, b, c'
+    with sqlite3.connect(os.path.join(wd, 'files.db')) as conn:
+        expected = sorted(conn.execute('select {} from filelist'.format(columns)).fetchall())
+    for fmt in ('csv', 'jsonl'):
+        outfile = os.path.join(wd, 'catalog.{}'.format(fmt))
+        assert filesdb.export_catalog(outfile, wd=wd) == 6
+        assert filesdb.import_catalog(outfile, db='{}.db'.format(fmt), wd=wd, copy_mode=True, chunksize=4) == 6
+        with sqlite3.connect(os.path.join(wd, '{}.db'.format(fmt))) as conn:
+            assert sorted(conn.execute('select {} from filelist'.format(columns)).fetchall()) == expected
+        assert filesdb.exists({'a': 1, 'b': 'x'}, db='{}.db'.format(fmt), wd=wd, environment={'git': 'abc', 'v': 2})
+        with pytest.raises(ValueError):
+            filesdb.import_catalog(outfile, db='new.db', wd=wd)
+    with open(os.path.join(wd, 'catalog.csv')) as f:
+        assert f.readline().strip() == 'filename,time,envhash,a,b,c,environment.git,environment.v'
+    assert filesdb.export_catalog(os.path.join(wd, 'small.jsonl'), {'a<': 2}, wd=wd) == 2
+
+    with open(os.path.join(wd, 'new.jsonl'), 'w') as f:
+        f.write('{"a": 1, "environment.git": "q"}\n\n{"a": 2}\n')
+    assert filesdb.import_catalog(os.path.join(wd, 'new.jsonl'), db='new.db', wd=wd, environment={'git': 'z'}) == 2
+    rows = filesdb.search({}, db='new.db', wd=wd, with_environments=True, order_by='a')
+    assert [(r['a'], r['git']) for r in rows] == [(1, 'q'), (2, 'z')]
+
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'export', '--format=csv', 'a>=3'])
+    assert len(out.decode().splitlines()) == 4
+    subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(wd), '--db=cmd.db', 'import', '--format=csv',
+                    '--copy_mode'], input=out, check=True)
+    assert sorted(r['a'] for r in filesdb.search({}, db='cmd.db', wd=wd)) == [3, 4, 9]
+    subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(wd), '--db=cmd.db', 'import'],
+                   input=b'{"a": 5}\n{"a": 6}\n', check=True)
+    assert len(filesdb.search({'a>': 4}, db='cmd.db', wd=wd)) == 3
+
+
+def test_catalog_bytes(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(a=1, b=b'\x00\x01'), dict(a=2, b='text')], wd=wd, environment={'key': b'\xff'})
+    for fmt in ('csv', 'jsonl'):
+        outfile = os.path.join(wd, 'catalog.{}'.format(fmt))
+        assert filesdb.export_catalog(outfile, wd=wd) == 2
+        assert filesdb.import_catalog(outfile, db='{}.db'.format(fmt), wd=wd, copy_mode=True) == 2
+        rows = filesdb.search({}, db='{}.db'.format(fmt), wd=wd, with_environments=True, order_by='a')
+        assert [(r['b'], r['key']) for r in rows] == [(b'\x00\x01', b'\xff'), ('text', b'\xff')]
+
+
 def test_cmd_None(tmpdir):
     subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(str(tmpdir)), 'add', 'field1=None'])
     assert len(filesdb.search(dict(field1=None), wd=str(tmpdir))) == 1
@@ -355,6 +636,107 @@ def test_delete_error(tmpdir):
         filesdb.delete(dict(), wd=str(tmpdir))
 
 
+def test_delete_many(tmpdir):
+    wd = str(tmpdir)
+    fnames = filesdb.add_many([dict(a=i % 3, b=i) for i in range(30)], wd=wd)
+    for fname in fnames:
+        with open(os.path.join(wd, fname), 'w') as f:
+            f.write('test')
+    # a directory can't be removed with os.remove
+    os.remove(os.path.join(wd, fnames[3]))
+    os.mkdir(os.path.join(wd, fnames[3]))
+    rows = filesdb.delete({'a': 0, 'b!': 6}, wd=wd, jobs=4)
+    assert sorted(r['b'] for r in rows) == [i for i in range(0, 30, 3) if i != 6]
+    assert list(rows.errors) == [fnames[3]]
+    assert os.path.exists(os.path.join(wd, fnames[6]))
+    assert not os.path.exists(os.path.join(wd, fnames[0]))
+    assert len(filesdb.search({}, wd=wd)) == 21
+    proc = subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'delete', '-j', '2', 'a=1'],
+                          stdout=subprocess.PIPE)
+    assert proc.returncode == 0
+    assert proc.stdout.decode().count('\n') == 11
+    assert len(filesdb.search({}, wd=wd)) == 11
+
+
+def test_delete_trash(tmpdir):
+    wd = str(tmpdir)
+    fnames = filesdb.add_many([dict(a=i % 2, b=i) for i in range(6)], wd=wd, environment={'git': 1})
+    for fname in fnames:
+        with open(os.path.join(wd, fname), 'w') as f:
+            f.write(fname)
+    rows = filesdb.delete({'a': 0}, wd=wd, trash=True)
+    assert len(rows) == 3
+    assert rows.errors == {}
+    assert len(filesdb.search({}, wd=wd)) == 3
+    assert not os.path.exists(os.path.join(wd, fnames[0]))
+    batchdir = os.path.join(wd, '.filesdb-trash', rows.batch)
+    assert os.path.exists(os.path.join(batchdir, 'files', fnames[0]))
+
+    assert filesdb.purge(wd=wd, older_than=3600) == []
+    batches = filesdb.purge(wd=wd, dryrun=True)
+    assert [(b['batch'], b['files']) for b in batches] == [(rows.batch, 3)]
+
+    restored = filesdb.undelete(rows.batch, wd=wd)
+    assert sorted(r['filename'] for r in restored) == sorted(fnames[::2])
+    assert not os.path.exists(batchdir)
+    assert len(filesdb.search({}, wd=wd, environment={'git': 1})) == 6
+    with open(os.path.join(wd, fnames[0])) as f:
+        assert f.read() == fnames[0]
+    with pytest.raises(FileNotFoundError):
+        filesdb.undelete(rows.batch, wd=wd)
+
+    out = subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'delete', '--trash', 'a=1'],
+                         stderr=subprocess.PIPE).stderr.decode()
+    batch = out.split()[-1]
+    assert len(filesdb.search({}, wd=wd)) == 3
+    # the file name was used again, so the batch can't be restored
+    filesdb.add(dict(a=2), wd=wd, filename=fnames[1])
+    with pytest.raises(RuntimeError):
+        filesdb.undelete(batch, wd=wd)
+    subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'purge', '--older_than=0s'])
+    assert os.listdir(os.path.join(wd, '.filesdb-trash')) == []
+
+
+def test_maintain(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(a=i, b=None, c='x' * 1000) for i in range(200)], wd=wd, environment={'git': 1})
+    filesdb.add(dict(a=-1, b=None), wd=wd, environment={'git': 2})
+    filesdb.index(wd=wd, create=['b'])
+    db = filesdb.Database(wd=wd)
+    db.add(dict(d=1, e=None), environment={'git': 3, 'host': None})
+    filesdb.delete({'a!': None}, wd=wd)
+    report = filesdb.maintain(wd=wd, drop_columns=True)
+    assert report['environments'] == 2
+    assert sorted(report['columns']) == ['environments.host', 'filelist.a', 'filelist.c', 'filelist.e']
+    assert report['reclaimed'] > 0
+    assert report['vacuum'] == 'incremental'
+    assert set(report['seconds']) == {'environments', 'columns', 'analyze', 'vacuum'}
+    assert sorted(_query_columns(db.conn, 'filelist')) == ['b', 'd', 'envhash', 'filename', 'metahash', 'time']
+    assert db.conn.execute('pragma auto_vacuum').fetchone()[0] == 2
+    # other connections add dropped columns again
+    db.add(dict(a=1, c=2))
+    db.add_many([dict(a=1, e=2)])
+    assert len(filesdb.search({'a': 1}, wd=wd)) == 2
+    filesdb.add(dict(a=2), wd=wd, environment={'git': 4})
+    db.close()
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'maintain', '--vacuum=full'])
+    assert out.decode().startswith('removed 0 environments')
+
+
+def test_maintain_old_database(tmpdir):
+    wd = str(tmpdir)
+    _legacy_db(os.path.join(wd, 'files.db'))
+    # the full vacuum needed to turn on incremental vacuums is only done when asked for
+    report = filesdb.maintain(wd=wd)
+    assert report['vacuum'] == 'skipped'
+    assert 'vacuum' not in report['seconds']
+    assert report['reclaimed'] >= 0
+    assert _get_database('files.db', wd).conn.execute('pragma auto_vacuum').fetchone()[0] == 0
+    assert filesdb.maintain(wd=wd, vacuum='full')['vacuum'] == 'full'
+    assert _get_database('files.db', wd).conn.execute('pragma auto_vacuum').fetchone()[0] == 2
+    assert filesdb.maintain(wd=wd)['vacuum'] == 'incremental'
+
+
 def test_db_dne_error(tmpdir):
     with pytest.raises(FileNotFoundError):
         filesdb.delete(dict(), wd=str(tmpdir))
@@ -551,6 +933,174 @@ def test_copy_copy_env(tmpdir):
     assert len(filesdb.search_envs({}, wd=outdir)) == 2
 
 
+def test_copy_many(tmpdir):
+    indir = os.path.join(str(tmpdir), 'indir')
+    os.mkdir(indir)
+    outdir = os.path.join(str(tmpdir), 'outdir')
+    os.mkdir(outdir)
+    fnames = filesdb.add_many([dict(a=i, b=i % 2) for i in range(10)], wd=indir, environment={'git': 100})
+    for fname in fnames:
+        with open(os.path.join(indir, fname), 'w') as f:
+            f.write(fname)
+    report = filesdb.copy_many({'b': 0}, outdir, wd=indir, jobs=3)
+    assert report['copied'] == 5
+    assert report['skipped'] == 0
+    assert report['errors'] == {}
+    assert report['bytes'] == sum(len(f) for f in fnames[::2])
+    # the columns can be in a different order
+    key = lambda r: r['filename']
+    assert (sorted(map(dict, filesdb.search({}, wd=outdir)), key=key) ==
+            sorted(map(dict, filesdb.search({'b': 0}, wd=indir)), key=key))
+    assert len(filesdb.search_envs({}, wd=outdir)) == 1
+    for fname in fnames[::2]:
+        assert filecmp.cmp(os.path.join(indir, fname), os.path.join(outdir, fname), shallow=False)
+
+    # already copied files are checked again, missing and conflicting files are reported
+    filesdb.add(dict(a=100), wd=outdir, filename=fnames[1])
+    os.remove(os.path.join(indir, fnames[3]))
+    report = filesdb.copy_many(fnames[:4] + ['missing'], outdir, wd=indir, copytype='hardlink')
+    assert report['copied'] == 0
+    assert report['skipped'] == 2
+    assert sorted(report['errors']) == sorted([fnames[1], fnames[3], 'missing'])
+    assert isinstance(report['errors'][fnames[1]], RuntimeError)
+    assert isinstance(report['errors']['missing'], FileNotFoundError)
+    assert len(filesdb.search({}, wd=outdir)) == 7
+
+    with pytest.raises(ValueError):
+        filesdb.copy_many(fnames, outdir, wd=indir, copytype='symlink')
+
+
+def test_copy_many_cmd(tmpdir):
+    indir = os.path.join(str(tmpdir), 'indir')
+    os.mkdir(indir)
+    outdir = os.path.join(str(tmpdir), 'outdir')
+    fnames = filesdb.add_many([dict(a=i) for i in range(3)], wd=indir)
+    for fname in fnames:
+        with open(os.path.join(indir, fname), 'w') as f:
+            f.write('test')
+    os.mkdir(outdir)
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(indir), 'copy', '--filenames=-', outdir],
+                                  input='\n'.join(fnames[:2]).encode()).decode()
+    assert out.startswith('copied 2 files')
+    assert len(filesdb.search({}, wd=outdir)) == 2
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(indir), 'copy', '--filenames=-', outdir],
+                                  input='\n'.join(fnames[:2]).encode()).decode()
+    assert out.startswith('copied 0 files') and '2 already copied' in out
+    proc = subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(indir), 'copy', '-j', '2', outdir, 'a=3'])
+    assert proc.returncode == 0
+    os.remove(os.path.join(indir, fnames[2]))
+    proc = subprocess.run(['python', '-m', 'filesdb', '--wd={}'.format(indir), 'copy', outdir, 'a=2'],
+                          stderr=subprocess.PIPE)
+    assert proc.returncode == 1
+    assert fnames[2] in proc.stderr.decode()
+
+
+def test_files_equal(tmpdir, monkeypatch):
+    wd = str(tmpdir)
+    path1 = os.path.join(wd, 'a')
+    path2 = os.path.join(wd, 'b')
+    with open(path1, 'wb') as f:
+        f.write(b'x' * 100 + b'y')
+    with open(path2, 'wb') as f:
+        f.write(b'x' * 100 + b'z')
+    monkeypatch.setattr(filesdb._filesdb, 'COMPARE_BUFSIZE', 16)
+    assert not _files_equal(path1, path2)
+    os.utime(path2, ns=(0, os.stat(path1).st_mtime_ns))
+    assert _files_equal(path1, path2, compare='stat')
+    assert _files_equal(path1, path2, digests=('d', 'd'))
+    assert not _files_equal(path1, path2, digests=('d', None))
+    with open(path2, 'wb') as f:
+        f.write(b'x' * 100)
+    assert not _files_equal(path1, path2)
+    os.remove(path2)
+    os.link(path1, path2)
+    assert _files_equal(path1, path2)
+    with pytest.raises(ValueError):
+        _files_equal(path1, path2, compare='size')
+
+    # copies keep the modification time
+    os.remove(path2)
+    _copy_file(path1, path2)
+    assert os.stat(path1).st_mtime_ns == os.stat(path2).st_mtime_ns
+    assert _files_equal(path1, path2, compare='stat')
+
+
+def test_checksum(tmpdir):
+    wd = str(tmpdir)
+    fnames = filesdb.add_many([dict(a=i) for i in range(4)], wd=wd)
+    for fname in fnames[:3]:
+        with open(os.path.join(wd, fname), 'w') as f:
+            f.write(fname)
+    report = filesdb.checksum({}, wd=wd, jobs=2)
+    assert report['hashed'] == 3
+    assert list(report['errors']) == [fnames[3]]
+    row = filesdb.search({'filename': fnames[0]}, wd=wd)[0]
+    assert row['checksum_algorithm'] == 'sha256'
+    assert row['checksum'] == hashlib.sha256(fnames[0].encode()).hexdigest()
+    assert row['checksum_size'] == len(fnames[0])
+    assert filesdb.checksum({}, wd=wd)['hashed'] == 0
+    assert filesdb.checksum({'a': 0}, wd=wd, algorithm='md5', force=True)['hashed'] == 1
+
+    report = filesdb.verify({}, wd=wd)
+    assert sorted(report['ok']) == sorted(fnames[:3])
+    assert report['unchecked'] == [fnames[3]]
+    assert report['bytes'] == 0
+
+    # touched but unchanged, modified with the same size, truncated, and removed
+    st = os.stat(os.path.join(wd, fnames[0]))
+    os.utime(os.path.join(wd, fnames[0]), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with open(os.path.join(wd, fnames[1]), 'w') as f:
+        f.write(fnames[0])
+    os.utime(os.path.join(wd, fnames[1]), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with open(os.path.join(wd, fnames[2]), 'w') as f:
+        f.write('x')
+    os.remove(os.path.join(wd, fnames[0]))
+    report = filesdb.verify({}, wd=wd)
+    assert report['missing'] == [fnames[0]]
+    assert sorted(report['changed']) == sorted(fnames[1:3])
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'verify'])
+
+
+def test_checksum_copy(tmpdir, monkeypatch):
+    indir = os.path.join(str(tmpdir), 'indir')
+    os.mkdir(indir)
+    outdir = os.path.join(str(tmpdir), 'outdir')
+    os.mkdir(outdir)
+    fname = filesdb.add(dict(a=1), wd=indir)
+    with open(os.path.join(indir, fname), 'w') as f:
+        f.write('test')
+    filesdb.copy_many([fname], outdir, wd=indir)
+    subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(indir), 'checksum'])
+    subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(outdir), 'checksum'])
+    # checksums don't conflict, and files with matching checksums in both databases are not read
+    monkeypatch.setattr('builtins.open', None)
+    assert filesdb.copy_many([fname], outdir, wd=indir)['errors'] == {}
+    monkeypatch.undo()
+    assert filesdb.merge_many([os.path.join(indir, 'files.db')], 'files.db', wd=outdir)[0]['skipped'] == 1
+    os.utime(os.path.join(outdir, fname), ns=(0, 0))
+    assert filesdb.copy_many([fname], outdir, wd=indir)['errors'] == {}
+
+
+def test_checksum_copy_changed(tmpdir):
+    indir = os.path.join(str(tmpdir), 'indir')
+    os.mkdir(indir)
+    outdir = os.path.join(str(tmpdir), 'outdir')
+    os.mkdir(outdir)
+    fname = filesdb.add(dict(a=1), wd=indir)
+    with open(os.path.join(indir, fname), 'w') as f:
+        f.write('test')
+    filesdb.checksum({}, wd=indir)
+    # the output file has the size and time recorded for the input, but different contents
+    with open(os.path.join(outdir, fname), 'w') as f:
+        f.write('best')
+    st = os.stat(os.path.join(indir, fname))
+    os.utime(os.path.join(outdir, fname), ns=(st.st_atime_ns, st.st_mtime_ns))
+    with pytest.raises(RuntimeError):
+        filesdb.copy(fname, outdir, wd=indir)
+    assert isinstance(filesdb.copy_many([fname], outdir, wd=indir)['errors'][fname], RuntimeError)
+
+
 def test_cmprows():
     r1 = dict(hi=2, there=3)
     r2 = dict(hi=2, there=3)
@@ -666,7 +1216,7 @@ def test_bad_key(tmpdir):
 def test_update_cols(tmpdir):
     db = 'files.db'
     conn = _get_conn(db, str(tmpdir))
-    for table, n in zip(['filelist', 'environments'], [5, 3]):
+    for table, n in zip(['filelist', 'environments'], [6, 3]):
         with conn:
             _update_columns_incontext(conn, table, {'test': 'hi', 'test2': 'hi2'})
             desc = conn.execute('select * from {}'.format(table)).description
@@ -754,6 +1304,87 @@ def test_back_compat(tmpdir):
     filesdb.add({'test': 2, 'test2': '2'}, wd=str(tmpdir), db='old_style.db')
 
 
+@pytest.mark.skipif(not os.path.exists('old_style.db'), reason='test database not found')
+def test_metahash_old_style(tmpdir):
+    shutil.copy('old_style.db', str(tmpdir / 'old_style.db'))
+    assert filesdb.exists({'test': 1, 'test2': '2'}, wd=str(tmpdir), db='old_style.db')
+    row = filesdb.search({}, wd=str(tmpdir), db='old_style.db')[0]
+    assert row['metahash'] == filesdb._filesdb._metahash({'test': 1, 'test2': '2'})
+
+
+@pytest.mark.skipif(not os.path.exists('old_style.db'), reason='test database not found')
+def test_merge_old_style_twice(tmpdir):
+    wd = str(tmpdir)
+    shutil.copy('old_style.db', str(tmpdir / 'a.db'))
+    filesdb.merge('a.db', 'out.db', wd=wd)
+    filesdb.merge('a.db', 'out.db', wd=wd)
+    assert len(filesdb.search({}, wd=wd, db='out.db')) == 1
+    assert filesdb.exists({'test': 1, 'test2': '2'}, wd=wd, db='out.db')
+
+
+def test_metahash(tmpdir):
+    wd = str(tmpdir)
+    fname = filesdb.add({'a': 1, 'b': '2.0', 'c': None}, wd=wd, prefix='x_', environment={'git': 1})
+    filesdb.add({'a': 1, 'b': 3}, wd=wd, filename='other')
+    filesdb.add_many([{'a': 2, 'd': True}], wd=wd)
+    assert filesdb.exists({'a': 1, 'b': 2}, wd=wd, environment={'git': 1})
+    assert not filesdb.exists({'a': 1, 'b': 2}, wd=wd)
+    assert not filesdb.exists({'a': 1}, wd=wd, environment={'git': 1})
+    assert filesdb.exists({'a': 2, 'd': 1}, wd=wd)
+    assert filesdb.exists({'a': 2, 'd': True, 'b': None}, wd=wd)
+    plan = _get_database('files.db', wd).conn.execute(
+        'explain query plan select * from filelist where metahash = ?', ('',)).fetchall()
+    assert 'filelist_metahash' in plan[0][-1]
+
+    assert filesdb.get_or_add({'a': 1, 'b': 2}, wd=wd, environment={'git': 1}) == (fname, False)
+    fname2, added = filesdb.get_or_add({'a': 1, 'b': 2}, wd=wd, prefix='y_')
+    assert added and fname2.startswith('y_')
+    assert filesdb.get_or_add({'a': 1, 'b': 2}, wd=wd) == (fname2, False)
+    # the same metadata can still be added with another file name
+    filesdb.add({'a': 1, 'b': 2}, wd=wd, filename='copy')
+    assert filesdb.get_or_add({'a': 1, 'b': 2}, wd=wd) == (fname2, False)
+    with pytest.raises(ValueError):
+        filesdb.add({'metahash': 1}, wd=wd)
+
+    assert subprocess.call(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'exists', 'a=2', 'd=1']) == 0
+    assert subprocess.call(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'exists', 'a=3']) == 1
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'add', '--get_or_add', 'a=1', 'b=3'])
+    assert out.decode().strip() == 'other'
+
+    # hashes survive copies and merges
+    outdir = os.path.join(wd, 'out')
+    os.mkdir(outdir)
+    filesdb.copy_many({'a': 1}, outdir, wd=wd)
+    assert filesdb.exists({'a': 1, 'b': 3}, wd=outdir)
+    filesdb.merge(os.path.join(wd, 'files.db'), 'merged.db', wd=outdir)
+    assert filesdb.exists({'a': 2, 'd': 1}, db='merged.db', wd=outdir)
+
+
+def test_search_many(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([dict(a=i, b=i % 2) for i in range(0, 10, 2)], wd=wd)
+    filesdb.add(dict(a=0, b=0), wd=wd, filename='dup')
+    filesdb.add(dict(a=1, b=1), wd=wd, environment={'git': 1})
+    probes = [dict(a=i, b=i % 2) for i in range(10)]
+    matches = filesdb.search_many(probes, wd=wd)
+    assert sorted(matches) == list(range(10))
+    assert [len(matches[i]) for i in range(10)] == [2, 0, 1, 0, 1, 0, 1, 0, 1, 0]
+    assert all(r['a'] == 4 for r in matches[4])
+    matches = filesdb.search_many(probes[:2] + probes[:2], wd=wd, environment=[None, {'git': 1}, {}, {'git': 2}])
+    assert [len(matches[i]) for i in range(4)] == [2, 1, 2, 0]
+    with pytest.raises(ValueError):
+        filesdb.search_many(probes, wd=wd, environment=[{}])
+
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'missing'],
+                                  input='\n'.join(json.dumps(p) for p in probes).encode()).decode()
+    assert [json.loads(line) for line in out.splitlines()] == probes[1::2]
+    # without a database, everything is missing
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), '--db=new.db', 'missing'],
+                                  input='\n'.join(json.dumps(p) for p in probes).encode()).decode()
+    assert [json.loads(line) for line in out.splitlines()] == probes
+    assert not os.path.exists(os.path.join(wd, 'new.db'))
+
+
 def test_search_env_only(tmpdir):
     db = 'filesdb'
     fname1 = filesdb.add({'fprop': 1, 'fprop2': 'two'}, wd=str(tmpdir), db=db, environment={'eprop': 'hi', 'eprop2': 8})
@@ -780,3 +1411,536 @@ def test_quote_fail(tmpdir):
     filesdb.add({'field1': 1}, wd=str(tmpdir))
     with pytest.raises(RuntimeError):
         filesdb.search({'"field1"': 1}, wd=str(tmpdir))
+
+
+def test_database_handle(tmpdir):
+    with filesdb.Database(wd=str(tmpdir)) as db:
+        fname = db.add({'field1': 1}, environment={'git': 1})
+        db.add({'field1': 2}, filename='2')
+        assert len(db.search({})) == 2
+        assert db.search({'field1': 1})[0]['filename'] == fname
+        assert len(db.search_envs({})) == 1
+        assert len(db.delete({'field1': 2})) == 1
+    assert len(filesdb.search({}, wd=str(tmpdir))) == 1
+
+
+def test_cached_database(tmpdir):
+    filesdb.add({'field1': 1}, wd=str(tmpdir))
+    database = _get_database('files.db', str(tmpdir))
+    filesdb.add({'field1': 2}, wd=str(tmpdir))
+    assert _get_database('files.db', str(tmpdir)) is database
+    assert len(filesdb.search({}, wd=str(tmpdir))) == 2
+    os.remove(os.path.join(str(tmpdir), 'files.db'))
+    with pytest.raises(FileNotFoundError):
+        filesdb.search({}, wd=str(tmpdir))
+    filesdb.add({'field1': 3}, wd=str(tmpdir))
+    assert _get_database('files.db', str(tmpdir)) is not database
+    assert len(filesdb.search({}, wd=str(tmpdir))) == 1
+
+
+def test_column_cache(tmpdir):
+    conn = _get_conn('files.db', str(tmpdir))
+    with conn:
+        _update_columns_incontext(conn, 'filelist', ['a', 'b'])
+    statements = []
+    conn.set_trace_callback(statements.append)
+    with conn:
+        _update_columns_incontext(conn, 'filelist', ['a', 'b', 'envhash'])
+    assert statements == []
+
+    # a column added through another connection is picked up when it is needed
+    conn2 = _get_conn('files.db', str(tmpdir))
+    with conn2:
+        _update_columns_incontext(conn2, 'filelist', ['c'])
+    with conn:
+        _update_columns_incontext(conn, 'filelist', ['a', 'c', 'd'])
+    assert {'a', 'b', 'c', 'd'} <= _query_columns(conn, 'filelist')
+    assert not any(s.startswith('alter table filelist add "c"') for s in statements)
+
+    # a stale cache still handles the concurrent alter
+    with conn2:
+        _update_columns_incontext(conn2, 'filelist', ['e'])
+    conn.schema_version = conn.execute('pragma schema_version').fetchone()[0]
+    with conn:
+        _update_columns_incontext(conn, 'filelist', ['e'])
+    assert 'e' in _query_columns(conn, 'filelist')
+
+
+def test_add_known_columns_no_schema_queries(tmpdir):
+    database = filesdb.Database(wd=str(tmpdir))
+    database.add({'a': 1, 'b': 2})
+    statements = []
+    database.conn.set_trace_callback(statements.append)
+    database.add({'a': 2, 'b': 2})
+    assert not any('pragma' in s.lower() or s.lower().startswith('select') for s in statements)
+    database.close()
+
+
+def test_known_environment(tmpdir):
+    wd = str(tmpdir)
+    database = filesdb.Database(wd=wd)
+    database.add({'a': 1}, environment={'git': 1})
+    statements = []
+    database.conn.set_trace_callback(statements.append)
+    database.add({'a': 2}, environment={'git': 1})
+    assert not any('environments' in s for s in statements)
+    # environments removed by another connection are added again
+    filesdb.delete({'a!': None}, wd=wd)
+    filesdb.maintain(wd=wd, vacuum=None)
+    database.add({'a': 3}, environment={'git': 1})
+    assert len(filesdb.search({}, wd=wd, environment={'git': 1})) == 1
+    # or by a rollback
+    with pytest.raises(sqlite3.IntegrityError):
+        with _transaction(database.conn):
+            _add_incontext({'a': 4}, database.conn, environment={'git': 2})
+            _add_incontext({'a': 3}, database.conn, environment={'git': 1})
+    database.add({'a': 4}, environment={'git': 2})
+    assert len(filesdb.search_envs({}, wd=wd)) == 2
+    database.close()
+
+
+def test_add_many_public(tmpdir):
+    env = {'git': 1}
+    fnames = filesdb.add_many([{'a': 1}, {'a': 2, 'b': 'x'}, {'a': 3}], wd=str(tmpdir), ext='.txt', prefix='p',
+                              environment=env)
+    assert len(fnames) == 3
+    assert all(f.startswith('p') and f.endswith('.txt') for f in fnames)
+    assert fnames[0] == filesdb.add({'a': 1}, wd=str(tmpdir), db='other.db', ext='.txt', prefix='p', environment=env)
+    rows = filesdb.search({}, wd=str(tmpdir))
+    assert [r['filename'] for r in rows] == fnames
+    assert rows[1]['b'] == 'x'
+    assert rows[2]['b'] is None
+    assert len({r['envhash'] for r in rows}) == 1
+    assert len(filesdb.search_envs({}, wd=str(tmpdir))) == 1
+
+    filesdb.add_many([{'a': 4}, {'a': 5}], wd=str(tmpdir), environment=[{'git': 1}, {'git': 2}])
+    assert len(filesdb.search_envs({}, wd=str(tmpdir))) == 2
+
+    # one transaction, so a failure adds nothing
+    with pytest.raises(sqlite3.IntegrityError):
+        filesdb.add_many([{'a': 6}, {'a': 1}], wd=str(tmpdir), ext='.txt', prefix='p', environment=env)
+    assert len(filesdb.search({}, wd=str(tmpdir))) == 5
+    with pytest.raises(ValueError):
+        filesdb.add_many([{'a': 7}, {'time': 1}], wd=str(tmpdir))
+    with pytest.raises(ValueError):
+        filesdb.add_many([{'a': 7}], wd=str(tmpdir), environment=[])
+
+
+def test_add_many_equal_environments(tmpdir, monkeypatch):
+    import filesdb._filesdb
+    wd = str(tmpdir)
+    added = []
+    add_environment = filesdb._filesdb._add_environment_incontext
+    monkeypatch.setattr(filesdb._filesdb, '_add_environment_incontext',
+                        lambda env, conn, **kwargs: added.append(env) or add_environment(env, conn, **kwargs))
+    # equal environments that are separate dictionaries are added once, but 0.0 and -0.0 hash differently
+    envs = [{'git': 1, 'x': 0.0} for _ in range(3)] + [{'x': 0.0, 'git': 1}, {'git': 1, 'x': -0.0}]
+    filesdb.add_many([{'a': i} for i in range(5)], wd=wd, environment=envs)
+    assert len(added) == 2
+    assert len({r['envhash'] for r in filesdb.search({}, wd=wd)}) == 2
+    matches = filesdb.search_many([{'a': i} for i in range(5)], wd=wd, environment=[dict(env) for env in envs])
+    assert [len(matches[i]) for i in range(5)] == [1] * 5
+
+
+def test_add_many_cmd(tmpdir):
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(str(tmpdir)), 'add_many', '--ext=.txt'],
+                                  input=b'{"a": 1, "b": "x"}\n\n{"a": 2}\n').decode()
+    fnames = out.split()
+    assert len(fnames) == 2
+    assert [r['filename'] for r in filesdb.search({}, wd=str(tmpdir))] == fnames
+
+
+def test_index(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add_many([{'a': i, 'b': i % 3, 'c': 'x'} for i in range(20)], wd=wd)
+    for i in range(3):
+        filesdb.search({'a': i, 'b': 1}, wd=wd)
+    filesdb.search({'c': 'x'}, wd=wd)
+    filesdb.search({'c!': 'x'}, wd=wd)
+    indexes = filesdb.index(wd=wd, min_count=2)
+    assert [(i['columns'], i['searches'], i['index'], i['recommended']) for i in indexes] == [
+        ('a,b', 3, None, True), ('c', 1, None, False)]
+
+    indexes = filesdb.index(wd=wd, auto=True, min_count=2)
+    assert indexes[0]['index'] == 'filesdb_index_a,b'
+    conn = _get_conn('files.db', wd)
+    assert 'filelist_envhash' in [r[0] for r in conn.execute("select name from sqlite_master where type = 'index'")]
+    plan = conn.execute('explain query plan select * from filelist where a = 1 and b = 1').fetchall()
+    assert 'filesdb_index_a,b' in ' '.join(str(r[-1]) for r in plan)
+
+    indexes = filesdb.index(wd=wd, create=['c'])
+    assert {i['columns']: i['index'] for i in indexes}['c'] == 'filesdb_index_c'
+    with pytest.raises(ValueError):
+        filesdb.index(wd=wd, create=['d'])
+    indexes = filesdb.index(wd=wd, drop=['c'])
+    assert {i['columns']: i['index'] for i in indexes}['c'] is None
+    indexes = filesdb.index(wd=wd, drop=[])
+    assert all(i['index'] is None for i in indexes)
+
+
+def test_index_cmd(tmpdir):
+    wd = '--wd={}'.format(str(tmpdir))
+    subprocess.check_call(['python', '-m', 'filesdb', wd, 'add', 'a=1', 'b=2'])
+    for _ in range(2):
+        subprocess.check_call(['python', '-m', 'filesdb', wd, 'search', 'a=1'])
+    out = subprocess.check_output(['python', '-m', 'filesdb', wd, 'index', '--list']).decode().split('\n')
+    assert out[1].split('\t')[:2] == ['a', '2']
+    subprocess.check_call(['python', '-m', 'filesdb', wd, 'index', '--create', 'a,b'])
+    out = subprocess.check_output(['python', '-m', 'filesdb', wd, 'index', '--auto', '--min_count=2']).decode()
+    assert 'filesdb_index_a,b' in out
+    assert 'filesdb_index_a\t' in out
+    out = subprocess.check_output(['python', '-m', 'filesdb', wd, 'index', '--drop']).decode()
+    assert 'filesdb_index' not in out
+
+
+def test_iter_search(tmpdir):
+    wd = str(tmpdir)
+    with pytest.raises(FileNotFoundError):
+        filesdb.iter_search({}, wd=wd)
+    fnames = filesdb.add_many([{'a': i % 2, 'b': i} for i in range(25)], wd=wd, environment={'git': 1})
+    rows = filesdb.iter_search({'a': 1}, wd=wd, arraysize=4)
+    assert not isinstance(rows, list)
+    assert [r['b'] for r in rows] == list(range(1, 25, 2))
+    assert [r['filename'] for r in filesdb.iter_search({}, wd=wd, arraysize=7)] == fnames
+    rows = list(filesdb.iter_search({}, wd=wd, environment={'git': 1}))
+    assert len(rows) == 25
+    assert rows[0]['git'] == 1
+    assert list(filesdb.iter_search({'a': 3}, wd=wd)) == []
+
+
+def test_column_cache_rollback(tmpdir):
+    database = filesdb.Database(wd=str(tmpdir))
+    database.add({'a': 1}, filename='1', environment={'git': 1})
+    with pytest.raises(sqlite3.IntegrityError):
+        database.add({'a': 1, 'b': 2}, filename='1', environment={'git': 2})
+    database.add({'a': 2, 'b': 2}, filename='2')
+    assert database.search({'b': 2})[0]['filename'] == '2'
+    database.close()
+
+
+def test_merge_sql(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add(dict(a=1, b='x'), db='in.db', wd=wd, filename='1', environment={'git': 1})
+    filesdb.add(dict(a=2, c=3.5), db='in.db', wd=wd, filename='2', environment={'git': 2})
+    filesdb.add(dict(a=3), db='in.db', wd=wd, filename='3')
+    with open(os.path.join(wd, '1'), 'w'):
+        pass
+    filesdb.copy('1', wd, db='in.db', wd=wd, outdb='out.db')
+    filesdb.add(dict(d=4), db='out.db', wd=wd, filename='4')
+    inrows = [dict(r) for r in filesdb.search({}, db='in.db', wd=wd)]
+    counts = filesdb.merge('in.db', 'out.db', wd=wd)
+    assert counts == {'inserted': 2, 'skipped': 1, 'conflicts': 0}
+    outrows = {r['filename']: r for r in filesdb.search({}, db='out.db', wd=wd)}
+    assert len(outrows) == 4
+    for r in inrows:
+        assert _cmprows(r, outrows[r['filename']])
+    assert outrows['4']['d'] == 4
+    assert len(filesdb.search_envs({}, db='out.db', wd=wd)) == 2
+    assert filesdb.search({}, db='out.db', wd=wd, environment={'git': 2})[0]['filename'] == '2'
+    # the input is unchanged
+    assert 'd' not in filesdb.search({}, db='in.db', wd=wd)[0].keys()
+    assert filesdb.merge('in.db', 'out.db', wd=wd) == {'inserted': 0, 'skipped': 3, 'conflicts': 0}
+
+    filesdb.add(dict(a=2, c=3.6), db='out2.db', wd=wd, filename='2')
+    with pytest.raises(RuntimeError):
+        filesdb.merge('in.db', 'out2.db', wd=wd)
+    assert len(filesdb.search({}, db='out2.db', wd=wd)) == 1
+    with pytest.raises(FileNotFoundError):
+        filesdb.merge('missing.db', 'out2.db', wd=wd)
+
+
+@pytest.mark.skipif(not os.path.exists('old_style.db'), reason='test database not found')
+def test_merge_old_style(tmpdir):
+    shutil.copy('old_style.db', str(tmpdir / 'old_style.db'))
+    filesdb.add({'test': 5}, wd=str(tmpdir), environment={'git': 1})
+    assert filesdb.merge('old_style.db', 'files.db', wd=str(tmpdir))['inserted'] == 1
+    rows = filesdb.search({'test': 1}, wd=str(tmpdir))
+    assert rows[0]['test2'] == 2
+    assert rows[0]['envhash'] is None
+
+
+def test_merge_many(tmpdir):
+    wd = str(tmpdir)
+    for i in range(4):
+        filesdb.add(dict(a=i), db='shard{}.db'.format(i), wd=wd, filename=str(i), environment={'git': i % 2})
+        filesdb.add({'a': i, 'col{}'.format(i): i}, db='shard{}.db'.format(i), wd=wd, environment={'git': 1})
+    filesdb.add(dict(a=100), db='shard4.db', wd=wd, filename='0')
+    shards = ['shard{}.db'.format(i) for i in range(5)]
+    counts = filesdb.merge_many(shards, 'out.db', wd=wd, on_conflict='skip', jobs=3)
+    assert [c['input'] for c in counts] == shards
+    assert [(c['inserted'], c['skipped'], c['conflicts']) for c in counts[:4]] == [(2, 0, 0)] * 4
+    assert (counts[4]['inserted'], counts[4]['skipped'], counts[4]['conflicts']) == (0, 0, 1)
+    rows = filesdb.search({}, db='out.db', wd=wd)
+    assert len(rows) == 8
+    assert all('col{}'.format(i) in rows[0].keys() for i in range(4))
+    assert len(filesdb.search_envs({}, db='out.db', wd=wd)) == 2
+    counts = filesdb.merge_many(shards[:4], 'out.db', wd=wd)
+    assert all(c['skipped'] == 2 for c in counts)
+    # each input is merged in its own transaction
+    with pytest.raises(RuntimeError):
+        filesdb.merge_many(shards, 'out2.db', wd=wd)
+    assert len(filesdb.search({}, db='out2.db', wd=wd)) == 8
+
+
+def test_merge_many_cmd(tmpdir):
+    wd = str(tmpdir)
+    filesdb.add(dict(a=1), db='in1.db', wd=wd, filename='1')
+    filesdb.add(dict(a=2), db='in2.db', wd=wd, filename='2')
+    filesdb.add(dict(a=3), db='in3.db', wd=wd, filename='2')
+    out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), '--db=out.db', 'merge', '--skip_conflicts',
+                                   'in1.db', 'in2.db', 'in3.db']).decode().split('\n')
+    assert out[0].split('\t') == ['input', 'inserted', 'skipped', 'conflicts']
+    assert out[3].split('\t') == ['in3.db', '0', '0', '1']
+    assert len(filesdb.search({}, db='out.db', wd=wd)) == 2
+
+
+def test_profiles(tmpdir, monkeypatch):
+    wd = str(tmpdir)
+    filesdb.add({'a': 1}, wd=wd, profile='wal')
+    database = _get_database('files.db', wd, profile='wal')
+    assert database.conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+    assert database.conn.execute('pragma synchronous').fetchone()[0] == 1
+    assert _get_database('files.db', wd) is not database
+    monkeypatch.setenv('FILESDB_PROFILE', 'bulk')
+    assert _get_database('files.db', wd).conn.execute('pragma synchronous').fetchone()[0] == 0
+    assert len(filesdb.search({}, wd=wd)) == 1
+    monkeypatch.setenv('FILESDB_PROFILE', 'fast')
+    with pytest.raises(ValueError):
+        filesdb.search({}, wd=wd)
+    monkeypatch.delenv('FILESDB_PROFILE')
+    subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(wd), '--profile=wal', 'add', 'a=2'])
+    assert len(filesdb.search({}, wd=wd)) == 2
+
+
+def _legacy_db(path):
+    # the schema of databases created before search statistics and metadata hashes
+    with sqlite3.connect(path) as conn:
+        conn.execute('create table filelist (filename text primary key not null, time timestamp, envhash text, a NUMERIC)')
+        conn.execute('create table environments (envhash text primary key not null)')
+        conn.execute("insert into filelist values ('f1', '2020-01-01 00:00:00', null, 1)")
+        conn.execute("insert into filelist values ('f2', '2020-01-01 00:00:00', null, 2)")
+    conn.close()
+
+
+def _connect_readonly(monkeypatch, wd):
+    # open the databases in wd as if they were on read-only storage
+    connect = sqlite3.connect
+
+    def connect_ro(path, *args, **kwargs):
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(wd):
+            return connect('file:{}?mode=ro'.format(os.path.abspath(path)), *args, uri=True, **kwargs)
+        return connect(path, *args, **kwargs)
+    monkeypatch.setattr(sqlite3, 'connect', connect_ro)
+
+
+def test_readonly_legacy(tmpdir, monkeypatch):
+    wd = str(tmpdir)
+    _legacy_db(os.path.join(wd, 'files.db'))
+    _connect_readonly(monkeypatch, wd)
+    assert [r['filename'] for r in filesdb.search({'a': 2}, wd=wd)] == ['f2']
+    assert len(list(filesdb.iter_search({}, wd=wd))) == 2
+    with pytest.raises(sqlite3.OperationalError):
+        filesdb.add({'a': 3}, wd=wd)
+    monkeypatch.undo()
+    filesdb._filesdb._close_databases()
+    # the schema is brought up to date once the database can be written
+    filesdb.add({'a': 3}, wd=wd)
+    assert len(filesdb.search({}, wd=wd)) == 3
+
+
+def test_metahash_lazy(tmpdir, monkeypatch):
+    wd = str(tmpdir)
+    path = os.path.join(wd, 'files.db')
+    _legacy_db(path)
+    # searching doesn't add the metadata hashes
+    assert len(filesdb.search({}, wd=wd)) == 2
+    assert 'metahash' not in _query_columns(sqlite3.connect(path), 'filelist')
+    filesdb._filesdb._close_databases()
+
+    # read-only databases are searched by column
+    _connect_readonly(monkeypatch, wd)
+    assert filesdb.exists({'a': 2}, wd=wd)
+    assert filesdb.exists({'a': '2', 'b': None}, wd=wd)
+    assert not filesdb.exists({'a': 3}, wd=wd)
+    assert not filesdb.exists({'b': 2}, wd=wd)
+    assert not filesdb.exists({'a': 2}, wd=wd, environment={'git': 1})
+    matches = filesdb.search_many([{'a': 1}, {'a': 3}], wd=wd)
+    assert [[r['filename'] for r in matches[i]] for i in range(2)] == [['f1'], []]
+    monkeypatch.undo()
+    filesdb._filesdb._close_databases()
+
+    # they are added on the first write or lookup
+    assert filesdb.exists({'a': 2}, wd=wd)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('select count(*) from filelist where metahash is null').fetchone()[0] == 0
+        # rows added by an older version
+        conn.execute("insert into filelist (filename, time, a) values ('f3', '2020-01-01 00:00:00', 3)")
+    conn.close()
+    assert filesdb.exists({'a': 3}, wd=wd)
+    filesdb._filesdb._close_databases()
+    with sqlite3.connect(path) as conn:
+        conn.execute("insert into filelist (filename, time, a) values ('f4', '2020-01-01 00:00:00', 4)")
+    conn.close()
+    filesdb.add({'a': 5}, wd=wd)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('select count(*) from filelist where metahash is null').fetchone()[0] == 0
+    conn.close()
+
+
+def test_wal_reader(tmpdir):
+    import time
+    wd = str(tmpdir)
+    filesdb.add({'a': 1}, wd=wd, profile='wal')
+    filesdb._filesdb._close_databases()
+    writer = sqlite3.connect(os.path.join(wd, 'files.db'), isolation_level=None)
+    writer.execute('begin immediate')
+    writer.execute("insert into filelist (filename, a) values ('f2', 2)")
+    try:
+        # readers don't wait for the writer, and don't see its changes before they are committed
+        start = time.time()
+        assert [r['a'] for r in filesdb.search({}, wd=wd, profile='wal', timeout=1)] == [1]
+        assert filesdb.exists({'a': 1}, wd=wd, profile='wal', timeout=1)
+        assert time.time() - start < 1
+    finally:
+        writer.execute('rollback')
+        writer.close()
+        filesdb._filesdb._close_databases()
+
+
+def test_busy_retry(tmpdir, monkeypatch):
+    import threading
+    import time
+    wd = str(tmpdir)
+    filesdb.add({'a': 1}, wd=wd)
+    monkeypatch.setitem(filesdb._filesdb.PROFILES, 'test', {'retries': 50, 'retry_delay': 0.01})
+    locker = sqlite3.connect(os.path.join(wd, 'files.db'), isolation_level=None, check_same_thread=False)
+    locker.execute('begin exclusive')
+    with pytest.raises(sqlite3.OperationalError):
+        filesdb.add({'a': 2}, wd=wd, timeout=0.01)
+    timer = threading.Timer(0.2, locker.execute, ['commit'])
+    start = time.time()
+    timer.start()
+    filesdb.add({'a': 2}, wd=wd, timeout=0.01, profile='test')
+    assert time.time() - start >= 0.2
+    timer.join()
+    locker.close()
+    assert len(filesdb.search({}, wd=wd)) == 2
+
+
+def test_make_rows_closes(monkeypatch):
+    from filesdb._filesdb import _make_rows
+    conns = []
+    connect = sqlite3.connect
+    monkeypatch.setattr(sqlite3, 'connect', lambda *args, **kwargs: conns.append(connect(*args, **kwargs)) or conns[-1])
+    rows = _make_rows(['filename', 'a'], [['f1', 1], ['f2', 2]])
+    assert [dict(r) for r in rows] == [{'filename': 'f1', 'a': 1}, {'filename': 'f2', 'a': 2}]
+    assert len(conns) == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        conns[0].execute('select 1')
+
+
+@pytest.fixture
+def server(tmpdir):
+    import threading
+    from filesdb._server import _Server
+    server = _Server(wd=str(tmpdir), batch_time=0.05)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_server(tmpdir, server, monkeypatch):
+    import threading
+    wd = str(tmpdir)
+    assert os.path.exists(os.path.join(wd, '.files.db.sock'))
+    fnames = []
+    threads = [threading.Thread(target=lambda i=i: fnames.append(filesdb.add({'a': i, 'b': b'\x00'}, wd=wd, ext='.txt')))
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(fnames) == 20
+    assert server.worker.commits < 20
+    fname = filesdb.add({'a': 100}, wd=wd, environment={'git': 1})
+    assert filesdb.add_many([{'a': 101}, {'a': 102}], wd=wd) == [filesdb.add({'a': 101}, wd=wd, db='other.db'),
+                                                                 filesdb.add({'a': 102}, wd=wd, db='other.db')]
+    with pytest.raises(sqlite3.IntegrityError):
+        filesdb.add({'a': 100}, wd=wd, environment={'git': 1})
+    with pytest.raises(ValueError):
+        filesdb.add({'time': 1}, wd=wd)
+
+    rows = filesdb.search({'a': 3}, wd=wd)
+    assert isinstance(rows, filesdb.RowList)
+    assert rows[0]['b'] == b'\x00'
+    assert rows[0][0] == rows[0]['filename']
+    assert filesdb.search({}, wd=wd, environment={'git': 1})[0]['filename'] == fname
+    assert len(filesdb.search({'a': 1000}, wd=wd)) == 0
+    assert len(filesdb.delete({'a': 101}, wd=wd)) == 1
+    with pytest.raises(ValueError):
+        filesdb.delete({}, wd=wd)
+    assert len(filesdb.search({}, wd=wd)) == 22
+    # iter_search also goes through the server
+    monkeypatch.setattr(filesdb.Database, 'iter_search', None)
+    assert sorted(r['a'] for r in filesdb.iter_search({'a<': 3}, wd=wd)) == [0, 1, 2]
+
+
+def test_server_fallback(tmpdir):
+    wd = str(tmpdir)
+    # a stale socket is ignored
+    with open(os.path.join(wd, '.files.db.sock'), 'w'):
+        pass
+    filesdb.add({'a': 1}, wd=wd)
+    assert len(filesdb.search({}, wd=wd)) == 1
+    proc = subprocess.Popen(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'serve'])
+    try:
+        for _ in range(100):
+            try:
+                socket_ok = filesdb._filesdb._server_call('files.db', wd, 'search', metadata={})
+                break
+            except filesdb._filesdb._NoServer:
+                import time
+                time.sleep(0.05)
+        assert len(socket_ok) == 1
+        subprocess.check_call(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'add', 'a=2'])
+        out = subprocess.check_output(['python', '-m', 'filesdb', '--wd={}'.format(wd), 'search', '-o', 'a',
+                                       '--order_by', 'a'])
+        assert out.decode().splitlines() == ['a', '1', '2']
+    finally:
+        proc.terminate()
+        proc.wait()
+    assert not os.path.exists(os.path.join(wd, '.files.db.sock'))
+    assert len(filesdb.search({}, wd=wd)) == 2
+
+
+def test_aio(tmpdir):
+    import asyncio
+    import filesdb.aio
+    wd = str(tmpdir)
+
+    async def main():
+        with pytest.raises(FileNotFoundError):
+            await filesdb.aio.search({}, wd=wd)
+        fnames = await asyncio.gather(*[filesdb.aio.add({'a': i}, wd=wd, environment={'git': 1}) for i in range(50)])
+        assert len(set(fnames)) == 50
+        assert await filesdb.aio.add_many([{'a': 100}, {'a': 101}], wd=wd) == [
+            filesdb.add({'a': 100}, wd=wd, db='other.db'), filesdb.add({'a': 101}, wd=wd, db='other.db')]
+        with pytest.raises(sqlite3.IntegrityError):
+            await filesdb.aio.add({'a': 0}, wd=wd, environment={'git': 1})
+        rows = await filesdb.aio.search({'a': 3}, wd=wd)
+        assert rows[0]['filename'] == fnames[3]
+        rows = [r async for r in filesdb.aio.iter_search({}, wd=wd, arraysize=7)]
+        assert len(rows) == 52
+        async for r in filesdb.aio.iter_search({}, wd=wd, arraysize=1):
+            break
+        filesdb.add({'a': 200}, wd=wd, db='other2.db')
+        counts = await filesdb.aio.merge('other2.db', 'files.db', wd=wd)
+        assert counts['inserted'] == 1
+
+    asyncio.run(main())
+    worker = filesdb.aio._get_worker('files.db', wd)
+    assert worker.commits < 50
+    filesdb.aio._stop_workers()